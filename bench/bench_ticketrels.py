@@ -0,0 +1,256 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Benchmark of the hot paths of the plugin on a synthetic set of
+tickets, built in an in-memory SQLite environment.
+
+Run from the root of the repository::
+
+    python bench/bench_ticketrels.py --tickets 2000 --depth 4 --fanout 5
+
+Each operation is run on a sample of the tickets, reporting its wall
+time and the number of SQL statements it executes.
+"""
+
+import json
+import os
+import random
+import sys
+import time
+from collections import deque
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import trac.ticket.api
+import trac.ticket.web_ui
+from genshi.builder import tag
+from trac.db import sqlite_backend
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
+
+from ticketrels.api import TicketRelationsSystem, \
+                           TicketParentChildRelations, TicketReference
+from ticketrels.cache import TicketInfoCache
+from ticketrels.graph import import_relations
+from ticketrels.model import TicketLinks
+from ticketrels.web_ui import TicketRelationsModule
+
+
+class SQLCounter(object):
+    """Count the statements executed by the SQLite backend."""
+
+    count = 0
+
+    def install(self):
+        rollback_on_error = sqlite_backend.PyFormatCursor._rollback_on_error
+        counter = self
+
+        def _rollback_on_error(cursor, function, *args, **kwargs):
+            counter.count += 1
+            return rollback_on_error(cursor, function, *args, **kwargs)
+        sqlite_backend.PyFormatCursor._rollback_on_error = _rollback_on_error
+
+
+def build_environment(options):
+    """Create an environment holding `options.tickets` tickets, as trees
+    of `options.depth` levels with `options.fanout` children per ticket,
+    and `options.refs` references per ticket on average."""
+    env = EnvironmentStub(default_data=True,
+                          enable=['trac.*', 'ticketrels.*'])
+    system = TicketRelationsSystem(env)
+    system.found_db_version = 0
+    system.upgrade_environment()
+
+    rnd = random.Random(options.seed)
+    now = int(time.time() * 1000000)
+    statuses = ['new', 'assigned', 'accepted', 'closed']
+    env.db_transaction.executemany("""
+        INSERT INTO ticket (id, type, time, changetime, owner, reporter,
+                            status, summary, description)
+        VALUES (%s, 'defect', %s, %s, %s, 'bench', %s, %s, '')
+        """,
+        [(id, now, now, 'user%d' % (id % 10), rnd.choice(statuses),
+          'Ticket %d' % id) for id in xrange(1, options.tickets + 1)])
+
+    # trees filled breadth first, a new root being started when the
+    # current tree has all its levels
+    relations, roots = [], []
+    parents = deque()
+    for id in xrange(1, options.tickets + 1):
+        if not parents:
+            roots.append(id)
+            parents.append([id, 0, 0])
+            continue
+        parent = parents[0]
+        relations.append((parent[0], 'child', id))
+        if parent[1] + 1 < options.depth:
+            parents.append([id, parent[1] + 1, 0])
+        parent[2] += 1
+        if parent[2] == options.fanout:
+            parents.popleft()
+
+    for id in xrange(1, options.tickets + 1):
+        count = int(options.refs) + (rnd.random() < options.refs % 1)
+        for ref in rnd.sample(xrange(1, options.tickets + 1), count):
+            if ref != id:
+                relations.append((id, 'ref', ref))
+                relations.append((ref, 'ref', id))
+    import_relations(env, relations, 'bench')
+    return env, roots
+
+
+def bench(name, func, args_list, counter, results, warm):
+    """Run `func` with each of the arguments, recording the total wall
+    time and number of SQL statements."""
+    elapsed = statements = 0
+    for args in args_list:
+        if not warm:
+            TicketInfoCache(counter.env).invalidate()
+        count = counter.count
+        start = time.time()
+        func(*args)
+        elapsed += time.time() - start
+        statements += counter.count - count
+    calls = len(args_list) or 1
+    results.append({
+        'operation': name,
+        'calls': len(args_list),
+        'total_ms': elapsed * 1000,
+        'mean_ms': elapsed * 1000 / calls,
+        'sql_per_call': float(statements) / calls,
+    })
+
+
+def run(options):
+    env, roots = build_environment(options)
+    counter = SQLCounter()
+    counter.env = env
+    counter.install()
+    rnd = random.Random(options.seed)
+    sample = rnd.sample(xrange(1, options.tickets + 1),
+                        min(options.sample, options.tickets))
+    tickets = [Ticket(env, id) for id in sample]
+    module = TicketRelationsModule(env)
+    results = []
+
+    def request(path='/'):
+        return MockRequest(env, path_info=path)
+
+    def validate(ticket):
+        req = request()
+        for manipulator in (TicketParentChildRelations(env),
+                            TicketReference(env)):
+            list(manipulator.validate_ticket(req, ticket))
+
+    def cross_reference(ticket):
+        refs = set(rnd.sample(xrange(1, options.tickets + 1), 3))
+        refs.discard(ticket.id)
+        TicketLinks(env, ticket).add_cross_reference('bench', refs)
+
+    def render_ticket(ticket):
+        req = request('/ticket/%s' % ticket.id)
+        data = {'ticket': ticket,
+                'fields': [{'name': 'parents'}, {'name': 'refs'}]}
+        module.post_process_request(req, 'ticket.html', data, None)
+        stream = tag.div(tag.div(id='ticket')).generate()
+        module.filter_stream(req, 'GET', 'ticket.html', stream,
+                             data).render('xhtml')
+
+    def query_page():
+        return [dict(id=t.id, parents=t['parents'], refs=t['refs'])
+                for t in tickets[:options.page]]
+
+    def filter_groups():
+        data = {'groups': [(None, query_page())], 'col': ['parents', 'refs']}
+        module._filter_groups(request('/query'), data)
+
+    def filter_row_groups():
+        rows = [{'cell_groups': [[
+                    {'header': {'col': 'parents'}, 'value': t['parents']},
+                    {'header': {'col': 'refs'}, 'value': t['refs']},
+                ]]} for t in query_page()]
+        data = {'row_groups': [(None, rows)]}
+        module._filter_row_groups(request('/report/1'), data)
+
+    bench('validate_ticket', validate, [(t, ) for t in tickets],
+          counter, results, options.warm)
+    bench('add_cross_reference', cross_reference, [(t, ) for t in tickets],
+          counter, results, options.warm)
+    bench('get_children', module.get_children,
+          [(id, ) for id in roots[:options.sample]],
+          counter, results, options.warm)
+    bench('filter_stream', render_ticket,
+          [(Ticket(env, id), ) for id in roots[:options.sample]],
+          counter, results, options.warm)
+    bench('_filter_groups', filter_groups, [()] * options.repeat,
+          counter, results, options.warm)
+    bench('_filter_row_groups', filter_row_groups, [()] * options.repeat,
+          counter, results, options.warm)
+    return results
+
+
+def main(args=sys.argv[1:]):
+    parser = OptionParser('%prog [options]')
+    parser.add_option('-n', '--tickets', type='int', default=1000,
+                      help='number of tickets')
+    parser.add_option('-d', '--depth', type='int', default=3,
+                      help='depth of the ticket trees')
+    parser.add_option('-f', '--fanout', type='int', default=5,
+                      help='number of children per ticket')
+    parser.add_option('-r', '--refs', type='float', default=0.5,
+                      help='average number of references per ticket')
+    parser.add_option('-s', '--sample', type='int', default=50,
+                      help='number of tickets each operation is run on')
+    parser.add_option('-p', '--page', type='int', default=100,
+                      help='number of rows of the query/report pages')
+    parser.add_option('--repeat', type='int', default=10,
+                      help='number of query/report pages rendered')
+    parser.add_option('--seed', type='int', default=0,
+                      help='seed of the random generator')
+    parser.add_option('--warm', action='store_true', default=False,
+                      help="don't empty the tickets cache between the calls")
+    parser.add_option('--json', action='store_true', default=False,
+                      help='write the results as JSON')
+    options, args = parser.parse_args(args)
+
+    results = run(options)
+    if options.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+        return
+
+    print '%-22s %6s %12s %10s %10s' % ('operation', 'calls', 'total (ms)',
+                                        'mean (ms)', 'SQL/call')
+    for result in results:
+        print '%(operation)-22s %(calls)6d %(total_ms)12.1f ' \
+              '%(mean_ms)10.2f %(sql_per_call)10.1f' % result
+
+
+if __name__ == '__main__':
+    main()
@@ -47,16 +47,22 @@ setup(
     },
 
     packages = find_packages(exclude=['*.tests*']),
+    test_suite = 'ticketrels.tests.test_suite',
     package_data = {
         'ticketrels': [
             'htdocs/css/*.css',
+            'htdocs/js/*.js',
             'locale/*.*',
             'locale/*/LC_MESSAGES/*.*',
+            'templates/*.html',
         ],
     },
     entry_points = {
         'trac.plugins': [
+            'ticketrels.admin = ticketrels.admin',
             'ticketrels.api = ticketrels.api',
+            'ticketrels.metrics = ticketrels.metrics',
+            'ticketrels.notification = ticketrels.notification',
             'ticketrels.web_ui = ticketrels.web_ui',
         ]
     }
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from trac.admin import AdminCommandError, IAdminCommandProvider
+from trac.core import *
+from trac.util.text import printout
+
+from api import _
+from graph import FORMATS, RELATIONS, format_relations, import_relations, \
+                  iter_relations, parse_relations
+from notification import TicketRelationsNotifier
+
+class TicketRelationsAdmin(Component):
+    """
+    [sub] trac-admin commands for ticket relations.
+    """
+
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+    def get_admin_commands(self):
+        yield ('ticketrels notify', '',
+               """Send the queued notifications of the parent tickets
+
+               The pending child ticket changes are commented on their
+               parents first. The notifications which failed are sent
+               again only after their retry delay.
+               """,
+               None, self._do_notify)
+        yield ('ticketrels export', '<jsonl|csv> [root=<id>] '
+                                    '[milestone=<name>] [type=<child|ref>]',
+               """Write the relations of the tickets as an edge list
+
+               Each edge has a source ticket, a relation ('child' when
+               the source is the parent of the target, or 'ref') and a
+               target ticket. The edges can be restricted to the subtree
+               of a ticket, to the tickets of a milestone or to a type
+               of relations.
+               """,
+               self._complete_format, self._do_export)
+        yield ('ticketrels import', '<jsonl|csv> <file>',
+               """Add the relations of an edge list to the tickets
+
+               The edge list is written by `ticketrels export`. The
+               relations are committed by chunks, the existing ones and
+               those to missing tickets are skipped.
+               """,
+               self._complete_format, self._do_import)
+
+    def _complete_format(self, args):
+        if len(args) == 1:
+            return sorted(FORMATS)
+
+    def _do_notify(self):
+        notifier = TicketRelationsNotifier(self.env)
+        notifier.comment_pending(0)
+        sent = notifier.send_queued()
+        printout(_('%(num)d notification(s) sent.', num=sent))
+
+    def _do_export(self, format, *filters):
+        self._check_format(format)
+        kwargs = {}
+        for filter in filters:
+            name, sep, value = filter.partition('=')
+            if name == 'root' and value.isdigit():
+                kwargs['root'] = int(value)
+            elif name == 'milestone' and sep:
+                kwargs['milestone'] = value
+            elif name == 'type' and value in RELATIONS:
+                kwargs['relations'] = [value]
+            else:
+                raise AdminCommandError(_('Invalid filter "%(filter)s"',
+                                          filter=filter))
+        for line in format_relations(iter_relations(self.env, **kwargs),
+                                     format):
+            printout(line, newline=False)
+
+    def _do_import(self, format, filename):
+        self._check_format(format)
+        with open(filename, 'rb') as f:
+            added, skipped = import_relations(self.env,
+                                              parse_relations(f, format),
+                                              'trac-admin')
+        printout(_('%(added)d relation(s) added, %(skipped)d skipped.',
+                   added=added, skipped=skipped))
+
+    def _check_format(self, format):
+        if format not in FORMATS:
+            raise AdminCommandError(_('Unknown format "%(format)s"',
+                                      format=format))
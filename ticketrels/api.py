@@ -35,7 +35,6 @@ from trac.core import *
 from trac.env import IEnvironmentSetupParticipant
 from trac.db import DatabaseManager
 from trac.resource import ResourceNotFound
-from trac.ticket.model import Ticket
 from trac.ticket.api import ITicketChangeListener, ITicketManipulator
 from trac.ticket.notification import TicketNotifyEmail
 from trac.config import ListOption
@@ -51,7 +50,10 @@ NUMBERS_RE = re.compile(r'\d+', re.U)
 _, tag_, N_, add_domain = domain_functions('ticketrels',
     '_', 'tag_', 'N_', 'add_domain')
 
-from model import TicketLinks
+from metrics import measured
+from model import GENERATION_NAME, HOURS_FIELDS, TicketLinks, get_path, \
+                  is_ancestor
+from cache import RelationsCache
 
 class TicketRelationsSystem(Component):
     """
@@ -98,37 +100,42 @@ class TicketRelationsSystem(Component):
     def upgrade_environment(self):
         db_manager, _ = DatabaseManager(self.env)._get_connector()
 
-        # update the version
-        old_data = {} # {table.name: (cols, rows)}
-        with self.env.db_transaction as db:
-            cursor = db.cursor()
-            if not self.found_db_version:
+        if not self.found_db_version:
+            with self.env.db_transaction as db:
+                cursor = db.cursor()
                 cursor.execute("""
                         INSERT INTO system (name, value) VALUES (%s, %s)
                         """,
                         (db_default.name, db_default.version))
-            else:
-                cursor.execute('UPDATE system SET value=%s WHERE name=%s',
-                               (db_default.version, db_default.name))
+                cursor.execute("""
+                        INSERT INTO system (name, value) VALUES (%s, '0')
+                        """,
+                        (GENERATION_NAME, ))
+
+                # insert the default table
                 for table in db_default.tables:
-                    cursor.execute('SELECT * FROM ' + table.name)
-                    cols = [x[0] for x in cursor.description]
-                    rows = cursor.fetchall()
-                    old_data[table.name] = (cols, rows)
-                    cursor.execute('DROP TABLE ' + table.name)
-
-            # insert the default table
-            for table in db_default.tables:
-                for sql in db_manager.to_sql(table):
-                    cursor.execute(sql)
-
-                # add old data
-                if table.name in old_data:
-                    cols, rows = old_data[table.name]
-                    sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
-                        (table.name, ','.join(cols), ','.join(['%s'] * len(cols)))
-                    for row in rows:
-                        cursor.execute(sql, row)
+                    for sql in db_manager.to_sql(table):
+                        cursor.execute(sql)
+        else:
+            # apply the upgrade scripts in turn, each one in its own
+            # transaction along with the version update, so that an
+            # interrupted upgrade resumes from the failed script
+            for i in xrange(self.found_db_version + 1,
+                            db_default.version + 1):
+                name = 'db%i' % i
+                try:
+                    upgrades = __import__('upgrades', globals(), locals(),
+                                          [name])
+                    script = getattr(upgrades, name)
+                except AttributeError:
+                    raise TracError('No upgrade module for version '
+                                    '%i (%s.py)' % (i, name))
+                with self.env.db_transaction as db:
+                    cursor = db.cursor()
+                    script.do_upgrade(self.env, i, cursor)
+                    cursor.execute('UPDATE system SET value=%s WHERE name=%s',
+                                   (i, db_default.name))
+                self.found_db_version = i
 
         # add the custom field
         cfield = self.config['ticket-custom']
@@ -160,10 +167,21 @@ class TicketParentChildRelations(Component):
         add_domain(self.env.path, locale_dir)
 
     # ITicketChangeListener methods
+    @measured
     def ticket_created(self, ticket):
         self.ticket_changed(ticket, '', ticket['reporter'], {'parents': ''})
 
+    @measured
     def ticket_changed(self, ticket, comment, author, old_values):
+        # the `hours` field of the Timing and Estimation plugin is added
+        # to `totalhours` without the change being in `old_values`
+        if any(f in old_values for f in HOURS_FIELDS + ('hours', )):
+            # before the changes of the parents, which roll up the new
+            # hours (and status)
+            TicketLinks(self.env, ticket).update_hours(old_values)
+        if 'status' in old_values:
+            TicketLinks(self.env, ticket).update_status(old_values['status'])
+
         if 'parents' not in old_values:
             return
 
@@ -178,80 +196,50 @@ class TicketParentChildRelations(Component):
         links.remove_child(author, old_parents - new_parents)
         links.add_child(author, new_parents - old_parents)
 
+    @measured
     def ticket_deleted(self, ticket):
-        with self.env.db_transaction as db:
-            cursor = db.cursor()
-            # TODO: check if there's any child ticket
-            cursor.execute("""
-                    DELETE FROM ticketrels
-                    WHERE child=%s AND relations='child'
-                    """,
-                    (ticket.id, ))
+        # TODO: check if there's any child ticket
+        links = TicketLinks(self.env, ticket)
+        links.delete_parents()
 
     # ITicketManipulator methods
     def prepare_ticket(self, req, ticket, fields, actions):
         pass
 
+    @measured
     def validate_ticket(self, req, ticket):
-        with self.env.db_query as db:
-            cursor = db.cursor()
+        try:
+            # the status of the parents is read from the database, as a
+            # parent may have just been closed by another process
+            cache = RelationsCache(self.env, shared=False)
+            _ids = cache.parse_ids(ticket['parents'])
+            # the existence and status of all the parents at once
+            parents = cache.get_tickets(i for i in _ids if i != ticket.id)
+            valid_ids = []
+            for x in _ids:
+                parent = parents.get(x)
+                if x == ticket.id:
+                    yield 'parents', _('A ticket cannot be a parent to itself')
+                elif parent is None:
+                    yield 'parents', _('Ticket #%s does not exist') % x
+                elif parent['status'] in self.restricted_status and ticket['status'] not in self.restricted_status:
+                    yield 'parents', _('Parent ticket #%s is closed') % x
+                    valid_ids.append(x)
+                elif ticket.id and is_ancestor(self.env, ticket.id, x):
+                    # check circularity, the parent must not be one of
+                    # the descendants
+                    path = get_path(self.env, ticket.id, x) or [x]
+                    error = ' > '.join(['#%s' % n for n in [ticket.id] + path[::-1]])
+                    yield 'parents', _('Circularity error: %s') % error
+                else:
+                    valid_ids.append(x)
 
-            try:
-                invalid_ids = set()
-                _ids = set(NUMBERS_RE.findall(ticket['parents'] or ''))
-                myid = str(ticket.id)
-                for id in _ids:
-                    if id == myid:
-                        invalid_ids.add(id)
-                        yield 'parents', _('A ticket cannot be a parent to itself')
-                    else:
-                        # check if the id exists
-                        cursor.execute("SELECT id FROM ticket WHERE id=%s", (id, ))
-                        row = cursor.fetchone()
-                        if row is None:
-                            invalid_ids.add(id)
-                            yield 'parents', _('Ticket #%s does not exist') % id
-
-                # circularity check function
-                def _check_parents(id, all_parents):
-                    all_parents = all_parents + [id]
-                    errors = []
-                    cursor.execute("""
-                            SELECT oneself FROM ticketrels
-                            WHERE ticket=%s AND relations='child'
-                            """,
-                            (id, ))
-                    for x in [int(x[0]) for x in cursor]:
-                        if x in all_parents:
-                            invalid_ids.add(x)
-                            error = ' > '.join(['#%s' % n for n in all_parents + [x]])
-                            errors.append(('parents', _('Circularity error: %s') % error))
-                        else:
-                            errors += _check_parents(x, all_parents)
-
-                    return errors
-
-                for x in [i for i in _ids if i not in invalid_ids]:
-                    # check parent ticket state
-                    try:
-                        parent = Ticket(self.env, x)
-                        if parent and parent['status'] in self.restricted_status and ticket['status'] not in self.restricted_status:
-                            yield 'parents', _('Parent ticket #%s is closed') % x
-                        else:
-                            # check circularity
-                            all_parents = ticket.id and [ticket.id] or []
-                            for error in _check_parents(int(x), all_parents):
-                                yield error
-                    except ResourceNotFound, e:
-                        invalid_ids.add(x)
-
-                valid_ids = _ids.difference(invalid_ids)
-                ticket['parents'] = valid_ids and ', '.join(sorted(valid_ids, key=lambda x: int(x))) or ''
-
-            except Exception, e:
-                import traceback
-                self.log.error(traceback.format_exc())
-                yield 'parents', _('Not a valid list of ticket IDs')
+            ticket['parents'] = ', '.join(str(x) for x in valid_ids)
+
+        except Exception, e:
+            import traceback
+            self.log.error(traceback.format_exc())
+            yield 'parents', _('Not a valid list of ticket IDs')
 
 class TicketReference(Component):
     """
@@ -270,6 +258,7 @@ class TicketReference(Component):
         return refs and refs.strip()
 
     # ITicketChangeListener methods
+    @measured
     def ticket_created(self, ticket):
         links = None
         desc_refs = self._get_refs(ticket['description'])
@@ -287,10 +276,12 @@ class TicketReference(Component):
             try:
                 refs = set([int(i) for i in NUMBERS_RE.findall(ticket['refs'])])
                 links.add_cross_reference(ticket["reporter"], refs)
+                links.sync_references()
 
             except Exception, err:
                 self.log.error('{0}: ticket_created {1}'.format(__name__, err))
 
+    @measured
     def ticket_changed(self, ticket, comment, author, old_values):
         links = None
         need_change = 'refs' in old_values
@@ -314,15 +305,18 @@ class TicketReference(Component):
                 new_refs = set([int(i) for i in NUMBERS_RE.findall(ticket['refs'])])
                 links.remove_cross_reference(author, old_refs - new_refs)
                 links.add_cross_reference(author, new_refs - old_refs)
+                links.sync_references()
             except Exception, err:
                 self.log.error('{0}: ticket_changed {1}'.format(__name__, err))
 
+    @measured
     def ticket_deleted(self, ticket):
         if self.has_ticket_refs(ticket):
             links = TicketLinks(self.env, ticket)
             try:
                 refs = set([int(i) for i in NUMBERS_RE.findall(ticket['refs'])])
                 links.remove_cross_reference("admin", refs)
+                links.sync_references()
             except Exception, err:
                 self.log.error('{0}: ticket_deleted {1}'.format(__name__, err))
 
@@ -330,14 +324,18 @@ class TicketReference(Component):
     def prepare_ticket(self, req, ticket, fields, actions):
         pass
 
+    @measured
     def validate_ticket(self, req, ticket):
         if self.has_ticket_refs(ticket):
             _prop = ('ticket-custom', 'refs.label')
+            cache = RelationsCache(self.env, shared=False)
+            tickets = cache.get_tickets(cache.parse_ids(ticket['refs']))
             for _id in ticket['refs'].replace(',', ' ').split():
                 try:
                     ref_id = int(_id)
                     assert ref_id != ticket.id
-                    Ticket(self.env, ref_id)
+                    if ref_id not in tickets:
+                        raise ResourceNotFound(_('Ticket #%s does not exist') % ref_id)
                 except ValueError:
                     msg = _('Input only numbers for ticket ID: {}').format(_id)
                     yield self.env.config.get(*_prop), msg
@@ -0,0 +1,288 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import threading
+from collections import OrderedDict
+
+from trac.config import IntOption
+from trac.core import *
+from trac.ticket.api import ITicketChangeListener
+from trac.web.api import IRequestFilter
+
+from api import NUMBERS_RE
+from model import get_changetimes, get_generation, get_tickets_info
+
+class GenerationCheck(object):
+    """Flush a process-wide cache at the beginning of a request when the
+    relations have changed in the database, see `model.bump_generation`.
+
+    The generation is read once per request for all the caches, through
+    the `RelationsCache` of the request.
+    """
+
+    # generation of the relations seen by the last check
+    _db_generation = None
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        self.check_generation(get_request_cache(self.env, req).generation)
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    def check_generation(self, generation=None):
+        """Flush the cache if the relations have changed in the database
+        since the last check, `generation` being read from the database
+        unless given."""
+        if generation is None:
+            generation = get_generation(self.env)
+        if generation != self._db_generation:
+            if self._db_generation is not None:
+                self.invalidate()
+            self._db_generation = generation
+
+class TicketInfoCache(GenerationCheck, Component):
+    """
+    [sub] Process-wide cache of the status, summary, type and owner of
+    the related tickets.
+
+    The cache is flushed at the beginning of a request when another
+    process has changed the relations since the previous request. The
+    tickets changed by this process are dropped from its own cache, and
+    the cached tickets are checked against their change time in the
+    database when they are requested, so that the ones changed by other
+    processes are loaded again.
+    """
+
+    implements(IRequestFilter, ITicketChangeListener)
+
+    ticket_cache_size = IntOption('ticketrels', 'ticket_cache_size', 1000,
+                                  doc=
+        """Number of tickets kept in the cache of the related tickets data
+        (0 disables the cache).
+        """)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tickets = OrderedDict()
+        # bumped on each invalidation, so that the data loaded meanwhile
+        # is not cached
+        self._generation = 0
+
+    # ITicketChangeListener methods
+    def ticket_created(self, ticket):
+        pass
+
+    def ticket_changed(self, ticket, comment, author, old_values):
+        self.invalidate([ticket.id])
+
+    def ticket_deleted(self, ticket):
+        self.invalidate([ticket.id])
+
+    def get_tickets(self, ids):
+        """Return the data of the tickets as `get_tickets_info` does,
+        loading only the ones not in the cache or changed since they were
+        cached."""
+        ids = set(int(i) for i in ids)
+        tickets = {}
+        with self._lock:
+            for id in ids:
+                if id in self._tickets:
+                    tickets[id] = self._tickets.pop(id)
+                    self._tickets[id] = tickets[id]
+            generation = self._generation
+
+        if tickets:
+            changetimes = get_changetimes(self.env, tickets)
+            stale = [id for id, ticket in tickets.iteritems()
+                     if changetimes.get(id) != ticket['changetime']]
+            if stale:
+                with self._lock:
+                    for id in stale:
+                        del tickets[id]
+                        self._tickets.pop(id, None)
+
+        missing = ids.difference(tickets)
+        if missing:
+            loaded = get_tickets_info(self.env, missing)
+            tickets.update(loaded)
+            size = self.ticket_cache_size
+            with self._lock:
+                if generation == self._generation and size > 0:
+                    self._tickets.update(loaded)
+                    while len(self._tickets) > size:
+                        self._tickets.popitem(last=False)
+        return tickets
+
+    def invalidate(self, ids=None):
+        """Drop the tickets from the cache, or all of them when `ids` is
+        `None`."""
+        with self._lock:
+            self._generation += 1
+            if ids is None:
+                self._tickets.clear()
+            else:
+                for id in ids:
+                    self._tickets.pop(int(id), None)
+
+class FragmentCache(GenerationCheck, Component):
+    """
+    [sub] Process-wide cache of the rendered relations of the tickets.
+
+    The fragments are keyed by the last change time of the related
+    tickets, and flushed like the `TicketInfoCache` when the relations
+    have changed.
+    """
+
+    implements(IRequestFilter)
+
+    fragment_cache_size = IntOption('ticketrels', 'fragment_cache_size', 100,
+                                    doc=
+        """Number of rendered relations kept in the cache (0 disables the
+        cache).
+        """)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fragments = OrderedDict()
+        self._generation = 0
+
+    def get_fragment(self, key, render):
+        """Return the fragment cached for `key`, or the one returned by
+        `render()`, cached if the relations have not changed meanwhile."""
+        with self._lock:
+            if key in self._fragments:
+                fragment = self._fragments.pop(key)
+                self._fragments[key] = fragment
+                return fragment
+            generation = self._generation
+
+        fragment = render()
+        size = self.fragment_cache_size
+        with self._lock:
+            if generation == self._generation and size > 0:
+                self._fragments[key] = fragment
+                while len(self._fragments) > size:
+                    self._fragments.popitem(last=False)
+        return fragment
+
+    def invalidate(self):
+        """Drop all the fragments from the cache."""
+        with self._lock:
+            self._generation += 1
+            self._fragments.clear()
+
+def get_request_cache(env, req):
+    """Return the relations cache shared by the hooks processing `req`.
+
+    A new cache is returned each time when `req` is `None`.
+    """
+    cache = getattr(req, '_ticketrels_cache', None)
+    if cache is None:
+        cache = RelationsCache(env)
+        if req is not None:
+            req._ticketrels_cache = cache
+    return cache
+
+class RelationsCache(object):
+    """A memo of the related tickets data loaded while processing a
+    request.
+
+    The tickets data is loaded through the `TicketInfoCache` unless
+    `shared` is false.
+    """
+
+    def __init__(self, env, shared=True):
+        self.env = env
+        self.shared = shared
+        self._tickets = {}
+        self._not_found = set()
+        self._children = {}
+        self._subtrees = {}
+        self._ids = {}
+        self._db_generation = None
+
+    @property
+    def generation(self):
+        """The generation of the relations in the database, read once."""
+        if self._db_generation is None:
+            self._db_generation = get_generation(self.env)
+        return self._db_generation
+
+    def get_tickets(self, ids, custom_fields=()):
+        """Return the status, summary, type, owner and `custom_fields` of
+        the tickets as `{id: {field: value}}`, loading the ones not seen
+        yet with `get_tickets_info`.
+        """
+        ids = set(int(i) for i in ids)
+        missing = [id for id in ids
+                      if id not in self._not_found and
+                         (id not in self._tickets or
+                          any(f not in self._tickets[id]
+                              for f in custom_fields))]
+        if missing:
+            info_cache = self.env[TicketInfoCache]
+            if info_cache and self.shared and not custom_fields:
+                tickets = info_cache.get_tickets(missing)
+            else:
+                tickets = get_tickets_info(self.env, missing, custom_fields)
+            for id in missing:
+                if id in tickets:
+                    self._tickets.setdefault(id, {}).update(tickets[id])
+                else:
+                    self._not_found.add(id)
+        return dict((id, self._tickets[id]) for id in ids
+                    if id in self._tickets)
+
+    def get_children(self, parent_id):
+        """Return the ids of the direct children of the ticket."""
+        if parent_id not in self._children:
+            self._children[parent_id] = [child for child, in
+                self.env.db_query("""
+                    SELECT ticket FROM ticketrels
+                    WHERE oneself=%s AND relations='child'
+                    """,
+                    (parent_id, ))]
+        return self._children[parent_id]
+
+    def get_subtree(self, parent_id, loader):
+        """Return the tree of descendants of the ticket, as built by
+        `loader(parent_id)` the first time."""
+        if parent_id not in self._subtrees:
+            self._subtrees[parent_id] = loader(parent_id)
+        return self._subtrees[parent_id]
+
+    def parse_ids(self, text):
+        """Return the sorted list of the ticket ids in `text`."""
+        text = text or ''
+        if text not in self._ids:
+            self._ids[text] = sorted(set(int(i) for i in
+                                         NUMBERS_RE.findall(text)))
+        return self._ids[text]
@@ -28,52 +28,332 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import sys
+from datetime import datetime
+from multiprocessing import Pool, cpu_count
 from optparse import OptionParser
+
 from trac.env import open_environment
+from trac.util.datefmt import utc, to_utimestamp
+from trac.util.text import exception_to_unicode
 
 from api import NUMBERS_RE
+from graph import update_field
+from model import add_subtree_hours, bump_generation, \
+                  compute_subtree_hours, update_closure
+
+# number of fixes applied in a single transaction
+BATCH_SIZE = 500
+
+# author of the changes of the fields made by the repair
+AUTHOR = 'ticketrels-checker'
+
+# custom field of the tickets holding each type of relations, the
+# ticket of the field being `ticketrels.ticket` for the parents and
+# `ticketrels.oneself` for the refs
+FIELDS = {'child': 'parents', 'ref': 'refs'}
+
+
+def merge_join(left, right):
+    """Generate `(key, in_left, in_right)` for the keys of two iterables
+    sorted in ascending order without duplicates."""
+    left, right = iter(left), iter(right)
+    l, r = next(left, None), next(right, None)
+    while l is not None or r is not None:
+        if r is None or l is not None and l < r:
+            yield l, True, False
+            l = next(left, None)
+        elif l is None or r < l:
+            yield r, False, True
+            r = next(right, None)
+        else:
+            yield l, True, True
+            l, r = next(left, None), next(right, None)
+
+
+def iter_query(db, query, args=()):
+    """Generate the rows of the query, fetched one by one."""
+    cursor = db.cursor()
+    cursor.execute(query, args)
+    for row in cursor:
+        yield row
+
+
+def iter_field(db, name):
+    """Generate the `(ticket, id)` pairs of the ids in the `name` custom
+    field of the tickets, sorted."""
+    for ticket, value in iter_query(db, """
+            SELECT ticket, value FROM ticket_custom
+            WHERE name=%s ORDER BY ticket
+            """, (name, )):
+        for id in sorted(set(int(i) for i in NUMBERS_RE.findall(value or ''))):
+            yield ticket, id
+
+
+def check_fields(env, relation):
+    """Return the `(ticket, id, in_field)` relations which differ between
+    the custom field and the `ticketrels` table."""
+    if relation == 'child':
+        # (child, parent)
+        query = """
+            SELECT ticket, oneself FROM ticketrels
+            WHERE relations='child' ORDER BY ticket, oneself
+            """
+    else:
+        # (ticket, referenced ticket)
+        query = """
+            SELECT oneself, ticket FROM ticketrels
+            WHERE relations='ref' ORDER BY oneself, ticket
+            """
+    with env.db_query as db:
+        return [key + (in_field, ) for key, in_field, in_table
+                in merge_join(iter_field(db, FIELDS[relation]),
+                              iter_query(db, query))
+                if in_field != in_table]
+
+
+def check_orphans(env):
+    """Return the `(oneself, relation, ticket)` relations to missing
+    tickets."""
+    with env.db_query as db:
+        return list(iter_query(db, """
+            SELECT r.oneself, r.relations, r.ticket FROM ticketrels r
+            LEFT OUTER JOIN ticket s ON (s.id=r.oneself)
+            LEFT OUTER JOIN ticket t ON (t.id=r.ticket)
+            WHERE s.id IS NULL OR t.id IS NULL
+            ORDER BY r.oneself, r.relations, r.ticket
+            """))
+
+
+def check_symmetry(env):
+    """Return the `(ticket, ref)` references which are not referenced
+    back."""
+    with env.db_query as db:
+        return [key for key, forward, backward in merge_join(
+                    iter_query(db, """
+                        SELECT oneself, ticket FROM ticketrels
+                        WHERE relations='ref' ORDER BY oneself, ticket
+                        """),
+                    iter_query(db, """
+                        SELECT ticket, oneself FROM ticketrels
+                        WHERE relations='ref' ORDER BY ticket, oneself
+                        """))
+                if forward and not backward]
+
+
+def check_cycles(env):
+    """Return the tickets which are their own ancestor.
+
+    The closure of a circular hierarchy doesn't hold the tickets as their
+    own ancestor (the backfill of the table leaves them out), but holds
+    each pair of the tickets of the cycle both ways.
+    """
+    with env.db_query as db:
+        return [id for id, in iter_query(db, """
+            SELECT DISTINCT a.ancestor FROM ticketrels_closure a
+            JOIN ticketrels_closure b
+             ON (b.ancestor=a.descendant AND b.descendant=a.ancestor)
+            ORDER BY a.ancestor
+            """)]
 
 
-def check_ticketrels(env):
+def check_hours(env):
+    """Return the `(ticket, sums, expected)` sums of the hours of the
+    descendants of the tickets which differ from the hours of their
+    descendants."""
     with env.db_query as db:
-        cursor = db.cursor()
-
-        cfield = {}
-        cursor.execute("SELECT ticket, value FROM ticket_custom WHERE name='parents'")
-        for row in cursor:
-            id = row[0]
-            parents = [int(x) for x in NUMBERS_RE.findall(row[1])]
-            cfield[id] = parents
-
-        subtickets = {}
-        cursor.execute("SELECT parent, child FROM subtickets")
-        for row in cursor:
-            parent = int(row[0])
-            child = int(row[1])
-            if child in subtickets:
-                subtickets[child] += [parent]
+        sums = dict((id, (estimated, total)) for id, estimated, total
+                    in iter_query(db, """
+                        SELECT ticket, estimatedhours, totalhours
+                        FROM ticketrels_hours
+                        """))
+        expected = compute_subtree_hours(db, [id for id, in iter_query(db, """
+                        SELECT DISTINCT ancestor FROM ticketrels_closure
+                        """)])
+    problems = []
+    for id in sorted(set(sums) | set(expected)):
+        stored = sums.get(id, (0.0, 0.0))
+        hours = expected.get(id, (0.0, 0.0))
+        if any(round(a - b, 6) for a, b in zip(stored, hours)):
+            problems.append((id, stored, hours))
+    return problems
+
+
+def _batches(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _add_relations(db, relations):
+    """Add the `(oneself, relation, ticket)` relations to the table."""
+    if not relations:
+        return
+    db.executemany("""
+       INSERT INTO ticketrels (oneself, relations, ticket)
+       VALUES (%s, %s, %s)
+       """,
+       relations)
+    for oneself, relation, ticket in relations:
+        if relation == 'child':
+            update_closure(db, oneself, ticket, 1)
+
+
+def _remove_relations(db, relations):
+    """Remove the `(oneself, relation, ticket)` relations from the
+    table."""
+    if not relations:
+        return
+    db.executemany("""
+       DELETE FROM ticketrels
+       WHERE oneself=%s AND relations=%s AND ticket=%s
+       """,
+       relations)
+    for oneself, relation, ticket in relations:
+        if relation == 'child':
+            update_closure(db, oneself, ticket, -1)
+
+
+def repair_fields(env, relation, problems, batch_size=BATCH_SIZE):
+    """Make the `ticketrels` table match the custom field, which is
+    the one shown to the users."""
+    for batch in _batches(problems, batch_size):
+        added, removed = [], []
+        for ticket, id, in_field in batch:
+            if relation == 'child':
+                row = (id, 'child', ticket)
+            else:
+                row = (ticket, 'ref', id)
+            (added if in_field else removed).append(row)
+        with env.db_transaction as db:
+            _add_relations(db, added)
+            _remove_relations(db, removed)
+            bump_generation(db)
+
+
+def repair_orphans(env, problems, batch_size=BATCH_SIZE):
+    """Remove the relations to missing tickets, from the table and from
+    the field of the remaining ticket."""
+    for batch in _batches(problems, batch_size):
+        time_stamp = to_utimestamp(datetime.now(utc))
+        removed = {'parents': {}, 'refs': {}}
+        for oneself, relation, ticket in batch:
+            if relation == 'child':
+                removed['parents'].setdefault(ticket, set()).add(oneself)
             else:
-                subtickets[child] = [parent]
+                removed['refs'].setdefault(oneself, set()).add(ticket)
+        with env.db_transaction as db:
+            _remove_relations(db, batch)
+            for name, values in removed.iteritems():
+                update_field(db, name, {}, values, AUTHOR, time_stamp)
+            bump_generation(db)
+
+
+def repair_symmetry(env, problems, batch_size=BATCH_SIZE):
+    """Add the missing back references."""
+    for batch in _batches(problems, batch_size):
+        time_stamp = to_utimestamp(datetime.now(utc))
+        added = {}
+        for ticket, ref in batch:
+            added.setdefault(ref, set()).add(ticket)
+        with env.db_transaction as db:
+            _add_relations(db, [(ref, 'ref', ticket) for ticket, ref in batch])
+            update_field(db, 'refs', added, {}, AUTHOR, time_stamp)
+            bump_generation(db)
 
-    for id in set(cfield.keys() + subtickets.keys()):
-        result = False
-        if id in cfield and id in subtickets:
-            cfield_values = set(cfield[id])
-            subtickets_values = set(subtickets[id])
-            if cfield_values == subtickets_values:
-                result = True
-        elif id not in subtickets:
-            if not cfield.get(id):
-                result = True
 
-        if not result:
-            print "Mismatch in ticket #%i" % id
-            print "  custom field :", cfield.get(id, '--')
-            print "  subtickets   :", subtickets.get(id, '--')
+def repair_hours(env, problems, batch_size=BATCH_SIZE):
+    """Set the sums of the hours of the descendants to the expected
+    ones."""
+    for batch in _batches(problems, batch_size):
+        with env.db_transaction as db:
+            add_subtree_hours(db, dict((id, (hours[0] - stored[0],
+                                             hours[1] - stored[1]))
+                                       for id, stored, hours in batch))
+            bump_generation(db)
+
+
+def check_environment(args):
+    """Check (and repair) the relations of an environment, returning the
+    lines of the report and the number of problems left.
+
+    An error (e.g. the plugin not being enabled in the environment) is
+    reported as the only line, the other environments being checked
+    anyway.
+    """
+    path, repair, batch_size = args
+    try:
+        env = open_environment(path, use_cache=False)
+    except Exception, e:
+        return path, ["Error: %s" % exception_to_unicode(e)], 1
+    try:
+        lines, left = _check_environment(env, repair, batch_size)
+    except Exception, e:
+        return path, ["Error: %s" % exception_to_unicode(e)], 1
+    finally:
+        env.shutdown()
+    return path, lines, left
+
+
+def _check_environment(env, repair, batch_size):
+    lines = []
+    left = 0
+
+    # the table is checked against the fields first, so that the next
+    # checks apply to the repaired relations
+    for relation in ('child', 'ref'):
+        problems = check_fields(env, relation)
+        for ticket, id, in_field in problems:
+            lines.append("Mismatch in ticket #%d: #%d only in the %s"
+                         % (ticket, id, "%s field" % FIELDS[relation]
+                                        if in_field else "ticketrels table"))
+        if repair:
+            repair_fields(env, relation, problems, batch_size)
+        else:
+            left += len(problems)
+
+    problems = check_orphans(env)
+    for oneself, relation, ticket in problems:
+        lines.append("Orphan relation: #%d %s #%d"
+                     % (oneself, relation, ticket))
+    if repair:
+        repair_orphans(env, problems, batch_size)
+    else:
+        left += len(problems)
+
+    problems = check_symmetry(env)
+    for ticket, ref in problems:
+        lines.append("Ticket #%d references #%d which doesn't reference "
+                     "it back" % (ticket, ref))
+    if repair:
+        repair_symmetry(env, problems, batch_size)
+    else:
+        left += len(problems)
+
+    problems = check_hours(env)
+    for id, stored, hours in problems:
+        lines.append("Hours of the descendants of ticket #%d: %g / %g "
+                     "instead of %g / %g" % ((id, ) + stored + hours))
+    if repair:
+        repair_hours(env, problems, batch_size)
+    else:
+        left += len(problems)
+
+    # a circular hierarchy has to be broken by hand
+    problems = check_cycles(env)
+    for id in problems:
+        lines.append("Circular hierarchy through ticket #%d" % id)
+    left += len(problems)
+
+    return lines, left
 
 
 def main(args=sys.argv[1:]):
     parser = OptionParser('%prog [options] project <project2> <project3> ...')
+    parser.add_option('-r', '--repair', action='store_true', default=False,
+                      help='fix the relations (but the circular ones)')
+    parser.add_option('-j', '--jobs', type='int', default=cpu_count(),
+                      help='number of environments checked in parallel')
+    parser.add_option('-b', '--batch-size', type='int', default=BATCH_SIZE,
+                      help='number of fixes applied in a transaction')
     options, args = parser.parse_args(args)
 
     # if no projects, print usage
@@ -81,17 +361,23 @@ def main(args=sys.argv[1:]):
         parser.print_help()
         sys.exit(0)
 
-    # get the environments
-    envs = []
-    for arg in args:
-        env = open_environment(arg)
-        envs.append(env)
+    # check all the environments, each one in its own process
+    pool = Pool(min(options.jobs, len(args)))
+    left = 0
+    try:
+        for path, lines, count in pool.imap(check_environment,
+                [(arg, options.repair, options.batch_size) for arg in args]):
+            print "%s: %s" % (path, "%d problem(s)" % len(lines)
+                                    if lines else "OK")
+            for line in lines:
+                print "  " + line
+            left += count
+    finally:
+        pool.close()
+        pool.join()
 
-    # check all the environments
-    for env in envs:
-        check_subtickets(env)
+    sys.exit(1 if left else 0)
 
 
 if __name__ == '__main__':
     main()
-
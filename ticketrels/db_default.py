@@ -27,15 +27,48 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from trac.db import Table, Column
+from trac.db import Table, Column, Index
 
 name = 'ticketrels'
-version = 2
+version = 10
 tables = [
     Table(name, key=('oneself', 'relations', 'ticket'))[
         Column('oneself', type='int'),
         Column('relations', type='text'),
         Column('ticket', type='int'),
+        Index(['ticket', 'relations']),
+        Index(['relations', 'oneself']),
+    ],
+    Table('ticketrels_closure', key=('ancestor', 'descendant', 'depth'))[
+        Column('ancestor', type='int'),
+        Column('descendant', type='int'),
+        Column('depth', type='int'),
+        Column('paths', type='int'),
+        Index(['descendant']),
+    ],
+    Table('ticketrels_notify', key=('ticket', 'modtime'))[
+        Column('ticket', type='int'),
+        Column('modtime', type='int64'),
+        Column('attempts', type='int'),
+        Column('next_attempt', type='int64'),
+        Index(['next_attempt']),
+    ],
+    Table('ticketrels_pending', key=('parent', 'child', 'time'))[
+        Column('parent', type='int'),
+        Column('child', type='int'),
+        Column('added', type='int'),
+        Column('author', type='text'),
+        Column('time', type='int64'),
+    ],
+    Table('ticketrels_hours', key='ticket')[
+        Column('ticket', type='int'),
+        Column('estimatedhours', type='real'),
+        Column('totalhours', type='real'),
+    ],
+    Table('ticketrels_children', key=('parent', 'status'))[
+        Column('parent', type='int'),
+        Column('status', type='text'),
+        Column('children', type='int'),
     ],
 ]
 
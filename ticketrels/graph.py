@@ -0,0 +1,274 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import csv
+import json
+from datetime import datetime
+
+from trac.core import TracError
+from trac.util.datefmt import utc, to_utimestamp
+
+from api import NUMBERS_RE, _
+from model import bump_generation, chunks, update_closure
+
+# formats of the edge lists, with their content type
+FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+RELATIONS = ('child', 'ref')
+
+# number of relations fetched by a single query of the export
+EXPORT_CHUNK_SIZE = 1000
+
+# number of relations imported in a single transaction
+IMPORT_CHUNK_SIZE = 500
+
+def iter_relations(env, relations=None, root=None, milestone=None,
+                   chunk_size=EXPORT_CHUNK_SIZE):
+    """Generate the `(source, relation, target)` rows of the `ticketrels`
+    table, `relation` being 'child' (`source` is the parent of `target`)
+    or 'ref'.
+
+    The rows are fetched by chunks of `chunk_size`, each query starting
+    after the last row of the previous one, so that the memory used
+    doesn't depend on the size of the graph.
+
+    :param relations: restrict to the given relation types
+    :param root: restrict to the relations of the ticket and of its
+                 descendants
+    :param milestone: restrict to the relations of the tickets of the
+                      milestone
+    """
+    where, args = [], []
+    if relations:
+        where.append('r.relations IN (%s)' % ','.join(['%s'] * len(relations)))
+        args.extend(relations)
+    if root is not None:
+        where.append("""(r.oneself=%s OR r.oneself IN (
+                            SELECT descendant FROM ticketrels_closure
+                            WHERE ancestor=%s))""")
+        args.extend([root, root])
+    if milestone is not None:
+        where.append("""(r.oneself IN (SELECT id FROM ticket
+                                       WHERE milestone=%s)
+                         OR r.ticket IN (SELECT id FROM ticket
+                                         WHERE milestone=%s))""")
+        args.extend([milestone, milestone])
+
+    last = None
+    while True:
+        keyset, keyset_args = [], []
+        if last is not None:
+            keyset.append("""(r.oneself>%s OR r.oneself=%s AND
+                              (r.relations>%s OR r.relations=%s AND
+                               r.ticket>%s))""")
+            keyset_args = [last[0], last[0], last[1], last[1], last[2]]
+        conditions = where + keyset
+        rows = env.db_query("""
+                SELECT r.oneself, r.relations, r.ticket FROM ticketrels r
+                %s
+                ORDER BY r.oneself, r.relations, r.ticket
+                LIMIT %d
+                """ % ('WHERE ' + ' AND '.join(conditions)
+                       if conditions else '', chunk_size),
+                args + keyset_args)
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            break
+        last = rows[-1]
+
+def format_relations(rows, format):
+    """Generate the lines (as `str`) of the edge list of the relations
+    in the given `format`."""
+    if format == 'csv':
+        yield 'source,relation,target\r\n'
+        for source, relation, target in rows:
+            yield '%d,%s,%d\r\n' % (source, relation.encode('utf-8'), target)
+    else:
+        for source, relation, target in rows:
+            yield json.dumps({'source': source, 'relation': relation,
+                              'target': target}, sort_keys=True) + '\n'
+
+def parse_relations(lines, format):
+    """Generate the `(source, relation, target)` rows of an edge list in
+    the given `format`, as written by `format_relations`."""
+    if format == 'csv':
+        records = csv.DictReader(lines)
+    else:
+        records = (json.loads(line) for line in lines if line.strip())
+
+    for num, record in enumerate(records, 1):
+        try:
+            source = int(record['source'])
+            relation = record['relation']
+            target = int(record['target'])
+        except (KeyError, TypeError, ValueError):
+            raise TracError(_('Invalid relation in record %(num)d.',
+                              num=num))
+        if relation not in RELATIONS:
+            raise TracError(_('Unknown relation "%(relation)s" in record '
+                              '%(num)d.', relation=relation, num=num))
+        yield source, relation, target
+
+def import_relations(env, rows, author, chunk_size=IMPORT_CHUNK_SIZE):
+    """Add the `(source, relation, target)` relations, as generated by
+    `parse_relations`, committing them by chunks of `chunk_size`.
+
+    The `parents` and `refs` fields of the tickets are updated along
+    with their history, but no notification is sent. The relations to
+    missing tickets, the existing ones and those which would make a
+    circular hierarchy are skipped.
+
+    :return: the numbers of added and skipped relations
+    """
+    added = skipped = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            counts = _import_chunk(env, chunk, author)
+            added, skipped = added + counts[0], skipped + counts[1]
+            chunk = []
+    if chunk:
+        counts = _import_chunk(env, chunk, author)
+        added, skipped = added + counts[0], skipped + counts[1]
+    return added, skipped
+
+def _import_chunk(env, rows, author):
+    """Add the relations in a single transaction."""
+    time_stamp = to_utimestamp(datetime.now(utc))
+    sources = sorted(set(row[0] for row in rows))
+    ids = sorted(set(sources + [row[2] for row in rows]))
+    added = {'parents': {}, 'refs': {}}
+    skipped = 0
+
+    with env.db_transaction as db:
+        existing_tickets = set()
+        for chunk in chunks(ids):
+            existing_tickets.update(id for id, in db("""
+                    SELECT id FROM ticket WHERE id IN (%s)
+                    """ % ','.join(['%s'] * len(chunk)), chunk))
+        existing = set()
+        for chunk in chunks(sources):
+            existing.update(db("""
+                    SELECT oneself, relations, ticket FROM ticketrels
+                    WHERE oneself IN (%s)
+                    """ % ','.join(['%s'] * len(chunk)), chunk))
+
+        for source, relation, target in rows:
+            if source == target or (source, relation, target) in existing \
+                    or source not in existing_tickets \
+                    or target not in existing_tickets:
+                skipped += 1
+                continue
+            if relation == 'child':
+                # the closure is kept up to date within the transaction
+                if db("""
+                      SELECT depth FROM ticketrels_closure
+                      WHERE ancestor=%s AND descendant=%s
+                      """,
+                      (target, source)):
+                    skipped += 1
+                    continue
+                update_closure(db, source, target, 1)
+                added['parents'].setdefault(target, set()).add(source)
+            else:
+                added['refs'].setdefault(source, set()).add(target)
+            existing.add((source, relation, target))
+
+        inserts = [(source, 'child', target) for target, parents
+                   in added['parents'].iteritems() for source in parents]
+        inserts += [(source, 'ref', target) for source, refs
+                    in added['refs'].iteritems() for target in refs]
+        if inserts:
+            db.executemany("""
+               INSERT INTO ticketrels (oneself, relations, ticket)
+               VALUES (%s, %s, %s)
+               """,
+               sorted(inserts))
+            for name, values in added.iteritems():
+                update_field(db, name, values, {}, author, time_stamp)
+            bump_generation(db)
+
+    return len(inserts), skipped
+
+def update_field(db, name, added, removed, author, time_stamp):
+    """Add and remove ids to/from the `name` custom field of the
+    tickets, given as `{ticket: ids}`, and record the changes in their
+    history."""
+    tickets = sorted(set(added) | set(removed))
+    old_values = {}
+    for chunk in chunks(tickets):
+        for id, value in db("""
+                SELECT ticket, value FROM ticket_custom
+                WHERE name=%%s AND ticket IN (%s)
+                """ % ','.join(['%s'] * len(chunk)), [name] + chunk):
+            old_values[id] = value
+
+    updates, inserts, changes, touched = [], [], [], []
+    for id in tickets:
+        old_value = old_values.get(id) or ''
+        old_ids = set(int(i) for i in NUMBERS_RE.findall(old_value))
+        ids = (old_ids | added.get(id, set())) - removed.get(id, set())
+        if ids == old_ids:
+            continue
+        new_value = u', '.join(str(i) for i in sorted(ids))
+        if id in old_values:
+            updates.append((new_value, id, name))
+        else:
+            inserts.append((id, name, new_value))
+        changes.append((id, time_stamp, author, name, old_value.strip(),
+                        new_value))
+        touched.append((time_stamp, id))
+
+    if updates:
+        db.executemany("""
+           UPDATE ticket_custom SET value=%s WHERE ticket=%s AND name=%s
+           """,
+           updates)
+    if inserts:
+        db.executemany("""
+           INSERT INTO ticket_custom (ticket, name, value)
+           VALUES (%s, %s, %s)
+           """,
+           inserts)
+    if changes:
+        db.executemany("""
+           INSERT INTO ticket_change
+           (ticket, time, author, field, oldvalue, newvalue)
+           VALUES (%s, %s, %s, %s, %s, %s)
+           """,
+           changes)
+        db.executemany("""
+           UPDATE ticket SET changetime=%s WHERE id=%s
+           """,
+           touched)
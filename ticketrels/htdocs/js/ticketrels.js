@@ -0,0 +1,21 @@
+(function($) {
+  // load the children of a child ticket below its row, or the next
+  // related tickets in place of the "show more" row
+  $(document).on('click', '#relations a.expandticketrels, #relations a.moreticketrels', function(e) {
+    e.preventDefault();
+    var link = $(this);
+    var row = link.closest('tr');
+    if (link.hasClass('loading'))
+      return;
+    link.addClass('loading');
+    $.getJSON(link.attr('href'), function(data) {
+      row.after($.map(data.rows, function(html) { return $(html)[0]; }));
+      if (link.hasClass('moreticketrels'))
+        row.remove();
+      else
+        link.remove();
+    }).fail(function() {
+      link.removeClass('loading');
+    });
+  });
+})(jQuery);
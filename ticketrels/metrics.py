@@ -0,0 +1,246 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import inspect
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+from trac.admin import IAdminPanelProvider
+from trac.config import BoolOption, IntOption
+from trac.core import *
+from trac.db.util import IterableCursor
+from trac.ticket.model import Ticket
+from trac.web.chrome import ITemplateProvider
+
+# numbers of SQL statements and ticket loads of each thread
+_counters = threading.local()
+
+_installed = False
+_install_lock = threading.Lock()
+
+def _count(name):
+    setattr(_counters, name, getattr(_counters, name, 0) + 1)
+
+def _get_counts():
+    return getattr(_counters, 'sql', 0), getattr(_counters, 'tickets', 0)
+
+def _install_counters():
+    """Count the SQL statements executed and the tickets loaded by each
+    thread, through the cursors of all the database backends and
+    `Ticket._fetch_ticket`."""
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        execute = IterableCursor.execute
+        executemany = IterableCursor.executemany
+        fetch_ticket = Ticket._fetch_ticket
+
+        def _execute(self, *args, **kwargs):
+            _count('sql')
+            return execute(self, *args, **kwargs)
+
+        def _executemany(self, *args, **kwargs):
+            _count('sql')
+            return executemany(self, *args, **kwargs)
+
+        def _fetch_ticket(self, *args, **kwargs):
+            _count('tickets')
+            return fetch_ticket(self, *args, **kwargs)
+
+        IterableCursor.execute = _execute
+        IterableCursor.executemany = _executemany
+        Ticket._fetch_ticket = _fetch_ticket
+        _installed = True
+
+def _measure_iterator(metrics, name, iterator):
+    """Generate the items of `iterator`, recording the time spent and the
+    SQL statements and ticket loads made while producing them once it is
+    exhausted or closed."""
+    elapsed = sql = tickets = 0
+    try:
+        while True:
+            start_sql, start_tickets = _get_counts()
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                end_sql, end_tickets = _get_counts()
+                elapsed += time.time() - start
+                sql += end_sql - start_sql
+                tickets += end_tickets - start_tickets
+            yield item
+    finally:
+        metrics.record(name, elapsed, sql, tickets)
+
+def measured(func):
+    """Decorate a method of a component (or of an object having an `env`)
+    to record the wall time, SQL statements and ticket loads of its calls
+    when the instrumentation is enabled.
+
+    The calls of a generator are measured as its items are consumed.
+    """
+    is_generator = inspect.isgeneratorfunction(func)
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        metrics = self.env[TicketRelationsMetrics]
+        if metrics is None or not metrics.enabled:
+            return func(self, *args, **kwargs)
+
+        # the instrumentation may be enabled after the component has been
+        # created
+        if not _installed:
+            _install_counters()
+        name = '%s.%s' % (self.__class__.__name__, func.__name__)
+        if is_generator:
+            return _measure_iterator(metrics, name,
+                                     func(self, *args, **kwargs))
+
+        sql, tickets = _get_counts()
+        start = time.time()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            end_sql, end_tickets = _get_counts()
+            metrics.record(name, elapsed, end_sql - sql,
+                           end_tickets - tickets)
+    return wrapper
+
+def percentile(values, percent):
+    """Return the `percent` percentile (nearest rank) of the sorted
+    `values`."""
+    if not values:
+        return None
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+class TicketRelationsMetrics(Component):
+    """
+    [extra] Measure the hooks of the ticket relations.
+    """
+
+    implements(IAdminPanelProvider, ITemplateProvider)
+
+    enabled = BoolOption('ticketrels', 'instrumentation', 'false', doc=
+        """Measure the wall time, SQL statements and ticket loads of the
+        hooks of the plugin, shown in the //Relations Metrics// admin
+        panel.
+        """)
+
+    slow_threshold = IntOption('ticketrels', 'slow_hook_threshold', 500, doc=
+        """Log the calls of the hooks taking at least this time, in
+        milliseconds, when the instrumentation is enabled (0 disables
+        the log).
+        """)
+
+    window = IntOption('ticketrels', 'metrics_window', 1000, doc=
+        """Number of the last calls of each hook the percentiles are
+        computed on.
+        """)
+
+    def __init__(self):
+        self._samples = {}
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, elapsed, sql, tickets):
+        """Record a call of the `name` hook."""
+        millis = elapsed * 1000
+        with self._lock:
+            if name not in self._samples:
+                self._samples[name] = deque(maxlen=max(self.window, 1))
+                self._calls[name] = 0
+            self._samples[name].append((millis, sql, tickets))
+            self._calls[name] += 1
+        if 0 < self.slow_threshold <= millis:
+            self.log.warning('ticketrels: %s took %.1f ms, %d SQL '
+                             'statement(s), %d ticket load(s)',
+                             name, millis, sql, tickets)
+
+    def get_metrics(self):
+        """Return the statistics of the recorded calls of each hook."""
+        with self._lock:
+            samples = dict((name, list(values))
+                           for name, values in self._samples.iteritems())
+            calls = dict(self._calls)
+
+        metrics = []
+        for name in sorted(samples):
+            values = samples[name]
+            times = sorted(value[0] for value in values)
+            metrics.append({
+                'name': name,
+                'calls': calls[name],
+                'p50': percentile(times, 50),
+                'p90': percentile(times, 90),
+                'p99': percentile(times, 99),
+                'max': times[-1],
+                'sql': float(sum(value[1] for value in values)) / len(values),
+                'tickets': float(sum(value[2] for value in values)) / len(values),
+            })
+        return metrics
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._calls.clear()
+
+    # ITemplateProvider methods
+    def get_htdocs_dirs(self):
+        return []
+
+    def get_templates_dirs(self):
+        from pkg_resources import resource_filename
+        return [resource_filename(__name__, 'templates')]
+
+    # IAdminPanelProvider methods
+    def get_admin_panels(self, req):
+        from api import _
+        if 'TRAC_ADMIN' in req.perm:
+            yield ('ticket', _('Ticket System'), 'relations_metrics',
+                   _('Relations Metrics'))
+
+    def render_admin_panel(self, req, cat, page, path_info):
+        req.perm.require('TRAC_ADMIN')
+        if req.method == 'POST' and 'reset' in req.args:
+            self.reset()
+            req.redirect(req.href.admin(cat, page))
+
+        data = {
+            'enabled': self.enabled,
+            'window': self.window,
+            'metrics': self.get_metrics(),
+        }
+        return 'ticketrels_admin_metrics.html', data
@@ -2,10 +2,451 @@
 from datetime import datetime
 
 from trac.ticket.model import Ticket
-from trac.ticket.notification import TicketNotifyEmail
 from trac.util.datefmt import utc, to_utimestamp
 
-from api import NUMBERS_RE, _
+from api import NUMBERS_RE
+from metrics import measured
+from notification import TicketRelationsNotifier
+
+# number of ids bound into a single `IN (...)` clause
+IN_CLAUSE_SIZE = 500
+
+def chunks(ids, size=IN_CLAUSE_SIZE):
+    """Split `ids` into lists of at most `size` items."""
+    ids = list(ids)
+    for i in xrange(0, len(ids), size):
+        yield ids[i:i + size]
+
+def get_tickets_info(env, ids, custom_fields=()):
+    """Return the status, summary, type, owner and change time (as an
+    utimestamp) of the tickets as `{id: {field: value}}`, fetching them
+    with one query per chunk of ids.
+
+    Values of `custom_fields` are added when given. Ids of the tickets
+    which don't exist are not included in the result.
+    """
+    tickets = {}
+    ids = sorted(set(int(i) for i in ids))
+    for chunk in chunks(ids):
+        holders = ','.join(['%s'] * len(chunk))
+        for id, status, summary, type, owner, changetime in env.db_query("""
+                SELECT id, status, summary, type, owner, changetime
+                FROM ticket WHERE id IN (%s)
+                """ % holders, chunk):
+            tickets[id] = {
+                'status': status,
+                'summary': summary,
+                'type': type,
+                'owner': owner,
+                'changetime': changetime,
+            }
+            for name in custom_fields:
+                tickets[id][name] = None
+
+        if custom_fields:
+            for id, name, value in env.db_query("""
+                    SELECT ticket, name, value FROM ticket_custom
+                    WHERE name IN (%s) AND ticket IN (%s)
+                    """ % (','.join(['%s'] * len(custom_fields)), holders),
+                    list(custom_fields) + chunk):
+                if id in tickets:
+                    tickets[id][name] = value
+    return tickets
+
+def get_changetimes(env, ids):
+    """Return the change times (as utimestamps) of the tickets as
+    `{id: changetime}`."""
+    changetimes = {}
+    for chunk in chunks(sorted(set(int(i) for i in ids))):
+        changetimes.update(env.db_query("""
+                SELECT id, changetime FROM ticket WHERE id IN (%s)
+                """ % ','.join(['%s'] * len(chunk)), chunk))
+    return changetimes
+
+def get_ancestors(env, id):
+    """Return the ids of all the ancestors of the ticket."""
+    return set(ancestor for ancestor, in env.db_query("""
+            SELECT DISTINCT ancestor FROM ticketrels_closure
+            WHERE descendant=%s
+            """,
+            (id, )))
+
+def get_descendants(env, id):
+    """Return the ids of all the descendants of the ticket."""
+    return set(descendant for descendant, in env.db_query("""
+            SELECT DISTINCT descendant FROM ticketrels_closure
+            WHERE ancestor=%s
+            """,
+            (id, )))
+
+def is_ancestor(env, ancestor, descendant):
+    """Return whether `ancestor` is an ancestor of `descendant`."""
+    for row in env.db_query("""
+            SELECT depth FROM ticketrels_closure
+            WHERE ancestor=%s AND descendant=%s
+            """,
+            (ancestor, descendant)):
+        return True
+    return False
+
+def get_path(env, ancestor, descendant):
+    """Return a list of ticket ids going down from `ancestor` to
+    `descendant` through the parent-child relations."""
+    path = [ancestor]
+    while path[-1] != descendant:
+        for child, in env.db_query("""
+                SELECT r.ticket FROM ticketrels r
+                LEFT OUTER JOIN ticketrels_closure c
+                  ON (c.ancestor=r.ticket AND c.descendant=%s)
+                WHERE r.oneself=%s AND r.relations='child'
+                  AND (r.ticket=%s OR c.ancestor IS NOT NULL)
+                ORDER BY COALESCE(c.depth, 0)
+                """,
+                (descendant, path[-1], descendant)):
+            break
+        else:
+            return None
+        if child in path:
+            return None
+        path.append(child)
+    return path
+
+def get_relations_page(env, id, relation, after=None, limit=0):
+    """Return the ids of the tickets related to the ticket by `relation`
+    ('child' or 'ref'), in ascending order, starting after the id `after`
+    and at most `limit` of them (0 for all)."""
+    return [ticket for ticket, in env.db_query("""
+            SELECT ticket FROM ticketrels
+            WHERE oneself=%%s AND relations=%%s AND ticket>%%s
+            ORDER BY ticket %s
+            """ % ('LIMIT %d' % limit if limit > 0 else ''),
+            (id, relation, after or 0))]
+
+def count_relations(env, id, relation, after=None):
+    """Return the number of tickets related to the ticket by `relation`
+    after the id `after`."""
+    for count, in env.db_query("""
+            SELECT COUNT(*) FROM ticketrels
+            WHERE oneself=%s AND relations=%s AND ticket>%s
+            """,
+            (id, relation, after or 0)):
+        return count
+    return 0
+
+def get_relations_changetime(env, id):
+    """Return the last change time of the ticket, its descendants and the
+    tickets it references."""
+    for changetime, in env.db_query("""
+            SELECT MAX(changetime) FROM ticket
+            WHERE id=%s
+               OR id IN (SELECT descendant FROM ticketrels_closure
+                         WHERE ancestor=%s)
+               OR id IN (SELECT ticket FROM ticketrels
+                         WHERE oneself=%s AND relations='ref')
+            """,
+            (id, id, id)):
+        return changetime
+    return None
+
+def get_references(env, id):
+    """Return the ids of the tickets referenced by the ticket."""
+    return set(ticket for ticket, in env.db_query("""
+            SELECT ticket FROM ticketrels
+            WHERE oneself=%s AND relations='ref'
+            """,
+            (id, )))
+
+def get_referrers(env, id):
+    """Return the ids of the tickets referencing the ticket."""
+    return set(oneself for oneself, in env.db_query("""
+            SELECT oneself FROM ticketrels
+            WHERE ticket=%s AND relations='ref'
+            """,
+            (id, )))
+
+# name of the row of the `system` table counting the changes of the
+# relations, to invalidate the caches of the other processes
+GENERATION_NAME = 'ticketrels_generation'
+
+def get_generation(env):
+    """Return the current generation of the relations."""
+    for value, in env.db_query("""
+            SELECT value FROM system WHERE name=%s
+            """,
+            (GENERATION_NAME, )):
+        return value
+    return None
+
+def bump_generation(db):
+    """Let the other processes know that the relations have changed."""
+    db("""
+       UPDATE system SET value=%s WHERE name=%%s
+       """ % db.cast(db.cast('value', 'int64') + '+1', 'text'),
+       (GENERATION_NAME, ))
+
+# custom fields of the hours, rolled up to the ancestors
+HOURS_FIELDS = ('estimatedhours', 'totalhours')
+
+def _to_hours(value):
+    try:
+        return float(value or 0)
+    except ValueError:
+        return 0.0
+
+def get_hours(db, ids):
+    """Return the estimated and total hours of the tickets as
+    `{id: (estimatedhours, totalhours)}`."""
+    hours = {}
+    for chunk in chunks(sorted(set(ids))):
+        for id, name, value in db("""
+                SELECT ticket, name, value FROM ticket_custom
+                WHERE name IN (%%s, %%s) AND ticket IN (%s)
+                """ % ','.join(['%s'] * len(chunk)),
+                list(HOURS_FIELDS) + chunk):
+            estimated, total = hours.get(id, (0.0, 0.0))
+            if name == 'estimatedhours':
+                hours[id] = (_to_hours(value), total)
+            else:
+                hours[id] = (estimated, _to_hours(value))
+    return hours
+
+def get_subtree_hours(env, id):
+    """Return the sums of the estimated and total hours of the
+    descendants of the ticket, or `None` if it has none."""
+    for estimated, total in env.db_query("""
+            SELECT estimatedhours, totalhours FROM ticketrels_hours
+            WHERE ticket=%s
+            """,
+            (id, )):
+        return estimated, total
+    return None
+
+def add_subtree_hours(db, deltas):
+    """Add the `{ticket: (estimatedhours, totalhours)}` deltas to the
+    sums of the hours of the descendants of the tickets."""
+    deltas = dict((id, delta) for id, delta in deltas.iteritems()
+                  if delta != (0.0, 0.0))
+    existing = set()
+    for chunk in chunks(sorted(deltas)):
+        existing.update(id for id, in db("""
+                SELECT ticket FROM ticketrels_hours WHERE ticket IN (%s)
+                """ % ','.join(['%s'] * len(chunk)), chunk))
+
+    updates = [deltas[id] + (id, ) for id in sorted(deltas) if id in existing]
+    inserts = [(id, ) + deltas[id] for id in sorted(deltas)
+               if id not in existing]
+    if updates:
+        db.executemany("""
+           UPDATE ticketrels_hours
+           SET estimatedhours=estimatedhours+%s, totalhours=totalhours+%s
+           WHERE ticket=%s
+           """,
+           updates)
+    if inserts:
+        db.executemany("""
+           INSERT INTO ticketrels_hours (ticket, estimatedhours, totalhours)
+           VALUES (%s, %s, %s)
+           """,
+           inserts)
+
+def compute_subtree_hours(db, ids):
+    """Return the sums of the estimated and total hours of the
+    descendants of the tickets, computed from the hours fields stored
+    in `ticket_custom`, as `{id: (estimatedhours, totalhours)}`."""
+    sums = {}
+    for chunk in chunks(sorted(set(ids))):
+        for ancestor, name, value in db("""
+                SELECT c.ancestor, tc.name, tc.value
+                FROM (SELECT DISTINCT ancestor, descendant
+                      FROM ticketrels_closure WHERE ancestor IN (%s)) c
+                JOIN ticket_custom tc ON (tc.ticket=c.descendant)
+                WHERE tc.name IN (%%s, %%s)
+                """ % ','.join(['%s'] * len(chunk)),
+                chunk + list(HOURS_FIELDS)):
+            estimated, total = sums.get(ancestor, (0.0, 0.0))
+            if name == 'estimatedhours':
+                sums[ancestor] = (estimated + _to_hours(value), total)
+            else:
+                sums[ancestor] = (estimated, total + _to_hours(value))
+    return sums
+
+def update_subtree_hours(db, pairs, hours=None):
+    """Add (`sign` = 1) or remove (`sign` = -1) the hours of each
+    descendant to/from the sums of its ancestor, for the `(ancestor,
+    descendant, sign)` pairs.
+
+    The hours of the tickets are read from the database unless given
+    in `hours`.
+    """
+    hours = dict(hours or {})
+    hours.update(get_hours(db, set(d for a, d, sign in pairs) - set(hours)))
+    deltas = {}
+    for ancestor, descendant, sign in pairs:
+        estimated, total = hours.get(descendant, (0.0, 0.0))
+        delta = deltas.get(ancestor, (0.0, 0.0))
+        deltas[ancestor] = (delta[0] + sign * estimated,
+                            delta[1] + sign * total)
+    add_subtree_hours(db, deltas)
+
+def get_children_statuses(env, id):
+    """Return the number of children of the ticket in each status, as
+    `{status: count}`."""
+    return dict(env.db_query("""
+            SELECT status, children FROM ticketrels_children WHERE parent=%s
+            """,
+            (id, )))
+
+def count_open_children(env, id, closed_statuses):
+    """Return the number of children of the ticket which are not in one
+    of the `closed_statuses`."""
+    sql = 'SELECT SUM(children) FROM ticketrels_children WHERE parent=%s'
+    if closed_statuses:
+        # `NOT IN ()` is not valid on PostgreSQL and MySQL
+        sql += ' AND status NOT IN (%s)' % \
+               ','.join(['%s'] * len(closed_statuses))
+    for count, in env.db_query(sql, [id] + list(closed_statuses)):
+        return count or 0
+    return 0
+
+def update_children_statuses(db, deltas):
+    """Add the `{(parent, status): delta}` deltas to the number of
+    children of the tickets in each status."""
+    deltas = dict((key, delta) for key, delta in deltas.iteritems() if delta)
+    existing = {}
+    for parent, status in deltas:
+        for count, in db("""
+                SELECT children FROM ticketrels_children
+                WHERE parent=%s AND status=%s
+                """,
+                (parent, status)):
+            existing[(parent, status)] = count
+
+    updates, inserts, deletes = [], [], []
+    for key in sorted(deltas):
+        count = existing.get(key, 0) + deltas[key]
+        if key not in existing:
+            if count > 0:
+                inserts.append(key + (count, ))
+        elif count > 0:
+            updates.append((count, ) + key)
+        else:
+            deletes.append(key)
+
+    if inserts:
+        db.executemany("""
+           INSERT INTO ticketrels_children (parent, status, children)
+           VALUES (%s, %s, %s)
+           """,
+           inserts)
+    if updates:
+        db.executemany("""
+           UPDATE ticketrels_children SET children=%s
+           WHERE parent=%s AND status=%s
+           """,
+           updates)
+    if deletes:
+        db.executemany("""
+           DELETE FROM ticketrels_children WHERE parent=%s AND status=%s
+           """,
+           deletes)
+
+def update_closure(db, parent, child, sign, hours=None, status=None):
+    """Add (`sign` = 1) or remove (`sign` = -1) the paths going through
+    the relation `parent` > `child` to/from the `ticketrels_closure`
+    table.
+
+    Each row counts the number of `paths` of a given `depth` from the
+    ancestor to the descendant, so that a relation can be removed
+    without recomputing the diamond-shaped hierarchies.
+
+    The sums of the hours of the ancestors are updated for the
+    descendants they gain or lose, `hours` overriding the hours of the
+    tickets as for `update_subtree_hours`, and the number of children
+    of the parent in the status of the child (read from the database
+    unless given).
+    """
+    if status is None:
+        for status, in db("SELECT status FROM ticket WHERE id=%s", (child, )):
+            pass
+    if status is not None:
+        update_children_statuses(db, {(parent, status): sign})
+
+    # ancestors of the parent and descendants of the child, themselves
+    # included
+    ancestors = [(parent, 0, 1)] + db("""
+            SELECT ancestor, depth, paths FROM ticketrels_closure
+            WHERE descendant=%s
+            """,
+            (parent, ))
+    descendants = [(child, 0, 1)] + db("""
+            SELECT descendant, depth, paths FROM ticketrels_closure
+            WHERE ancestor=%s
+            """,
+            (child, ))
+
+    changes = {}
+    for ancestor, depth1, paths1 in ancestors:
+        for descendant, depth2, paths2 in descendants:
+            key = (ancestor, descendant, depth1 + 1 + depth2)
+            changes[key] = changes.get(key, 0) + sign * paths1 * paths2
+
+    existing = {}
+    for ancestor_ids in chunks(set(x[0] for x in ancestors)):
+        for descendant_ids in chunks(set(x[0] for x in descendants)):
+            for ancestor, descendant, depth, paths in db("""
+                    SELECT ancestor, descendant, depth, paths
+                    FROM ticketrels_closure
+                    WHERE ancestor IN (%s) AND descendant IN (%s)
+                    """ % (','.join(['%s'] * len(ancestor_ids)),
+                             ','.join(['%s'] * len(descendant_ids))),
+                    ancestor_ids + descendant_ids):
+                existing[(ancestor, descendant, depth)] = paths
+
+    inserts, updates, deletes = [], [], []
+    for key, paths in changes.iteritems():
+        paths += existing.get(key, 0)
+        if key not in existing:
+            if paths > 0:
+                inserts.append(key + (paths, ))
+        elif paths > 0:
+            updates.append((paths, ) + key)
+        else:
+            deletes.append(key)
+
+    if inserts:
+        db.executemany("""
+                INSERT INTO ticketrels_closure
+                (ancestor, descendant, depth, paths)
+                VALUES (%s, %s, %s, %s)
+                """,
+                inserts)
+    if updates:
+        db.executemany("""
+                UPDATE ticketrels_closure SET paths=%s
+                WHERE ancestor=%s AND descendant=%s AND depth=%s
+                """,
+                updates)
+    if deletes:
+        db.executemany("""
+                DELETE FROM ticketrels_closure
+                WHERE ancestor=%s AND descendant=%s AND depth=%s
+                """,
+                deletes)
+
+    # a descendant is counted once in the hours of its ancestor, however
+    # many paths lead to it
+    before, after = {}, {}
+    for (ancestor, descendant, depth), paths in existing.iteritems():
+        before[(ancestor, descendant)] = \
+            before.get((ancestor, descendant), 0) + paths
+    after.update(before)
+    for (ancestor, descendant, depth), paths in changes.iteritems():
+        after[(ancestor, descendant)] = \
+            after.get((ancestor, descendant), 0) + paths
+    update_subtree_hours(db, [pair + (1 if paths > 0 else -1, )
+                              for pair, paths in after.iteritems()
+                              if (paths > 0) != (before.get(pair, 0) > 0)],
+                         hours)
 
 class TicketLinks(object):
     """A model for the ticket links as cross reference."""
@@ -17,7 +458,9 @@ class TicketLinks(object):
         self.ticket = ticket
         self.time_stamp = to_utimestamp(datetime.now(utc))
 
+    @measured
     def add_child(self, author, parents):
+        notifier = TicketRelationsNotifier(self.env)
         with self.env.db_transaction as db:
             cursor = db.cursor()
 
@@ -27,14 +470,19 @@ class TicketLinks(object):
                         VALUES(%s, 'child', %s)
                         """,
                         (parent, self.ticket.id))
+                update_closure(db, int(parent), self.ticket.id, 1)
 
                 # add a comment to new parent
-                xticket = Ticket(self.env, parent)
-                xticket.save_changes(author, _('Add a child ticket #%s (%s).') % (self.ticket.id, self.ticket['summary']))
-                tn = TicketNotifyEmail(self.env)
-                tn.notify(xticket, newticket=False, modtime=xticket['changetime'])
+                notifier.child_changed(db, parent, self.ticket, author, True)
+
+            if parents:
+                bump_generation(db)
+
+        notifier.wake()
 
+    @measured
     def remove_child(self, author, parents):
+        notifier = TicketRelationsNotifier(self.env)
         with self.env.db_transaction as db:
             cursor = db.cursor()
 
@@ -44,102 +492,220 @@ class TicketLinks(object):
                         WHERE oneself=%s AND relations='child' AND ticket=%s
                         """,
                         (parent, self.ticket.id))
+                update_closure(db, int(parent), self.ticket.id, -1)
 
                 # add a comment to removed parent
-                xticket = Ticket(self.env, parent)
-                xticket.save_changes(author, _('Remove a child ticket #%s (%s).') % (self.ticket.id, self.ticket['summary']))
-                tn = TicketNotifyEmail(self.env)
-                tn.notify(xticket, newticket=False, modtime=xticket['changetime'])
+                notifier.child_changed(db, parent, self.ticket, author, False)
+
+            if parents:
+                bump_generation(db)
+
+        notifier.wake()
 
+    @measured
+    def delete_parents(self):
+        """Remove the relations to all the parents of the ticket, without
+        commenting on the parents."""
+        # the hours of the ticket are not in the database anymore
+        hours = {self.ticket.id: tuple(_to_hours(self.ticket[f])
+                                       for f in HOURS_FIELDS)}
+        with self.env.db_transaction as db:
+            for parent, in db("""
+                    SELECT oneself FROM ticketrels
+                    WHERE ticket=%s AND relations='child'
+                    """,
+                    (self.ticket.id, )):
+                db("""
+                   DELETE FROM ticketrels
+                   WHERE oneself=%s AND relations='child' AND ticket=%s
+                   """,
+                   (parent, self.ticket.id))
+                update_closure(db, parent, self.ticket.id, -1, hours,
+                               self.ticket['status'])
+                bump_generation(db)
+
+    @measured
+    def update_hours(self, old_values):
+        """Apply the changes of the hours of the ticket to the sums of
+        its ancestors.
+
+        The new hours are the ones stored in the database rather than the
+        ones of the ticket, as other plugins (e.g. the Timing and
+        Estimation plugin for `totalhours`) update the fields directly
+        in the database.
+        """
+        with self.env.db_transaction as db:
+            hours = get_hours(db, [self.ticket.id]).get(self.ticket.id,
+                                                        (0.0, 0.0))
+            delta = tuple(new - _to_hours(old_values.get(f, self.ticket[f]))
+                          for new, f in zip(hours, HOURS_FIELDS))
+            if delta == (0.0, 0.0):
+                return
+            add_subtree_hours(db, dict((ancestor, delta) for ancestor, in db("""
+                    SELECT DISTINCT ancestor FROM ticketrels_closure
+                    WHERE descendant=%s
+                    """,
+                    (self.ticket.id, ))))
+
+    @measured
+    def update_status(self, old_status):
+        """Move the ticket from its `old_status` to its current one in
+        the numbers of children of its parents."""
+        status = self.ticket['status']
+        if status == old_status:
+            return
+        with self.env.db_transaction as db:
+            deltas = {}
+            for parent, in db("""
+                    SELECT oneself FROM ticketrels
+                    WHERE ticket=%s AND relations='child'
+                    """,
+                    (self.ticket.id, )):
+                deltas[(parent, old_status)] = -1
+                deltas[(parent, status)] = 1
+            update_children_statuses(db, deltas)
+
+    @measured
     def add_reference(self, refs):
         for ref_id in refs:
             self._add_reference_to_custom_table(ref_id)
+        self.sync_references()
 
+    @measured
+    def sync_references(self):
+        """Make the `ref` relations of the ticket match its `refs` field."""
+        with self.env.db_transaction as db:
+            self._sync_ref_relations(db, [self.ticket.id])
+
+    @measured
     def add_cross_reference(self, author, refs):
         with self.env.db_transaction as db:
-            for ref_id in refs:
-                for ref, in db("""
-                               SELECT value FROM ticket_custom
-                               WHERE ticket=%s AND name='refs'
-                               """,
-                               (ref_id,)):
-                    ref = ref or ''
+            values = self._get_refs_values(db, refs)
+            updates, inserts, changes, touched = [], [], [], []
+            for ref_id in sorted(refs):
+                if ref_id in values:
+                    ref = values[ref_id] or ''
                     target_refs = set([int(i) for i in NUMBERS_RE.findall(ref)])
+                    if self.ticket.id in target_refs:
+                        continue
 
-                    if self.ticket.id not in target_refs:
-                        target_refs.add(self.ticket.id)
-                        new_text = u', '.join(str(i) for i in sorted(target_refs))
-                        db("""
-                           UPDATE ticket_custom SET value=%s
-                           WHERE ticket=%s AND name='refs'
-                           """,
-                           (new_text, ref_id))
-                        db("""
-                           INSERT INTO ticket_change
-                           (ticket, time, author, field, oldvalue, newvalue)
-                           VALUES (%s, %s, %s, 'refs', %s, %s)
-                           """,
-                           (ref_id, self.time_stamp, author, ref.strip(), new_text))
-                        db("""
-                           UPDATE ticket SET changetime=%s WHERE id=%s
-                           """,
-                           (self.time_stamp, ref_id))
-                    break
+                    target_refs.add(self.ticket.id)
+                    new_text = u', '.join(str(i) for i in sorted(target_refs))
+                    updates.append((new_text, ref_id))
+                    changes.append((ref_id, self.time_stamp, author, ref.strip(), new_text))
                 else:
-                    db("""
-                       INSERT INTO ticket_custom (ticket, name, value)
-                       VALUES (%s, 'refs', %s)
-                       """,
-                       (ref_id, self.ticket.id))
-                    db("""
-                       INSERT INTO ticket_change
-                       (ticket, time, author, field, oldvalue, newvalue)
-                       VALUES (%s, %s, %s, 'refs', %s, %s)
-                       """,
-                       (ref_id, self.time_stamp, author, "", self.ticket.id))
-                    db("""
-                       UPDATE ticket SET changetime=%s WHERE id=%s
-                       """,
-                       (self.time_stamp, ref_id))
+                    inserts.append((ref_id, self.ticket.id))
+                    changes.append((ref_id, self.time_stamp, author, "", self.ticket.id))
+                touched.append((self.time_stamp, ref_id))
+
+            if updates:
+                db.executemany("""
+                   UPDATE ticket_custom SET value=%s
+                   WHERE ticket=%s AND name='refs'
+                   """,
+                   updates)
+            if inserts:
+                db.executemany("""
+                   INSERT INTO ticket_custom (ticket, name, value)
+                   VALUES (%s, 'refs', %s)
+                   """,
+                   inserts)
+            self._save_refs_changes(db, changes, touched)
+            self._sync_ref_relations(db, [id for t, id in touched])
+            if touched:
+                bump_generation(db)
 
+    @measured
     def remove_cross_reference(self, author, refs):
         with self.env.db_transaction as db:
-            for ref_id in refs:
-                ref = None
-                for ref, in db("""
-                               SELECT value FROM ticket_custom
-                               WHERE ticket=%s AND name='refs'
-                               """,
-                               (ref_id,)):
-                    break
-
-                ref = ref or ''
+            values = self._get_refs_values(db, refs)
+            updates, deletes, changes, touched = [], [], [], []
+            for ref_id in sorted(refs):
+                ref = values.get(ref_id) or ''
                 target_refs = set([int(i) for i in NUMBERS_RE.findall(ref)])
+                if self.ticket.id not in target_refs:
+                    continue
+
                 target_refs.remove(self.ticket.id)
                 if target_refs:
                     new_text = u', '.join(str(i) for i in sorted(target_refs))
-                    db("""
-                       UPDATE ticket_custom SET value=%s
-                       WHERE ticket=%s AND name='refs'
-                       """,
-                       (new_text, ref_id))
+                    updates.append((new_text, ref_id))
                 else:
                     new_text = ''
-                    db("""
-                       DELETE FROM ticket_custom
-                       WHERE ticket=%s AND name='refs'
-                       """,
-                       (ref_id,))
-                db("""
-                   INSERT INTO ticket_change
-                   (ticket, time, author, field, oldvalue, newvalue)
-                   VALUES (%s, %s, %s, 'refs', %s, %s)
+                    deletes.append((ref_id, ))
+                changes.append((ref_id, self.time_stamp, author, ref.strip(), new_text))
+                touched.append((self.time_stamp, ref_id))
+
+            if updates:
+                db.executemany("""
+                   UPDATE ticket_custom SET value=%s
+                   WHERE ticket=%s AND name='refs'
                    """,
-                   (ref_id, self.time_stamp, author, ref.strip(), new_text))
-                db("""
-                   UPDATE ticket SET changetime=%s WHERE id=%s
+                   updates)
+            if deletes:
+                db.executemany("""
+                   DELETE FROM ticket_custom
+                   WHERE ticket=%s AND name='refs'
                    """,
-                   (self.time_stamp, ref_id))
+                   deletes)
+            self._save_refs_changes(db, changes, touched)
+            self._sync_ref_relations(db, [id for t, id in touched])
+            if touched:
+                bump_generation(db)
+
+    def _get_refs_values(self, db, ids):
+        """Return the `refs` values of the tickets as `{id: value}`."""
+        values = {}
+        for chunk in chunks(sorted(set(ids))):
+            for id, value in db("""
+                    SELECT ticket, value FROM ticket_custom
+                    WHERE name='refs' AND ticket IN (%s)
+                    """ % ','.join(['%s'] * len(chunk)), chunk):
+                values[id] = value
+        return values
+
+    def _sync_ref_relations(self, db, ids):
+        """Make the `ref` relations of the tickets in the `ticketrels`
+        table match their `refs` field."""
+        values = self._get_refs_values(db, ids)
+        for chunk in chunks(sorted(set(ids))):
+            existing = set(db("""
+                    SELECT oneself, ticket FROM ticketrels
+                    WHERE relations='ref' AND oneself IN (%s)
+                    """ % ','.join(['%s'] * len(chunk)), chunk))
+            wanted = set((id, int(ref)) for id in chunk
+                         for ref in NUMBERS_RE.findall(values.get(id) or ''))
+
+            if wanted - existing:
+                db.executemany("""
+                   INSERT INTO ticketrels (oneself, relations, ticket)
+                   VALUES (%s, 'ref', %s)
+                   """,
+                   sorted(wanted - existing))
+            if existing - wanted:
+                db.executemany("""
+                   DELETE FROM ticketrels
+                   WHERE oneself=%s AND relations='ref' AND ticket=%s
+                   """,
+                   sorted(existing - wanted))
+            if wanted != existing:
+                bump_generation(db)
+
+    def _save_refs_changes(self, db, changes, touched):
+        """Record the changes of the `refs` field in the tickets history
+        and update their change time."""
+        if changes:
+            db.executemany("""
+               INSERT INTO ticket_change
+               (ticket, time, author, field, oldvalue, newvalue)
+               VALUES (%s, %s, %s, 'refs', %s, %s)
+               """,
+               changes)
+        if touched:
+            db.executemany("""
+               UPDATE ticket SET changetime=%s WHERE id=%s
+               """,
+               touched)
 
     def _add_reference_to_custom_table(self, ref_id):
         with self.env.db_transaction as db:
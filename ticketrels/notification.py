@@ -0,0 +1,327 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import threading
+from datetime import datetime, timedelta
+
+from trac.config import BoolOption, IntOption
+from trac.core import *
+from trac.resource import ResourceNotFound
+from trac.ticket.model import Ticket
+from trac.ticket.notification import TicketNotifyEmail
+from trac.util.datefmt import utc, from_utimestamp, to_utimestamp
+from trac.util.text import exception_to_unicode
+from trac.web.api import IRequestFilter
+
+# seconds between two checks of the queue by the background worker
+POLL_INTERVAL = 30
+
+# number of queued notifications sent per batch
+BATCH_SIZE = 100
+
+class TicketRelationsNotifier(Component):
+    """
+    [sub] Comments on the parent tickets and sends their change
+    notifications.
+    """
+
+    implements(IRequestFilter)
+
+    async_notification = BoolOption('ticketrels', 'async_notification',
+                                     'true', doc=
+        """Queue the change notifications of the parent tickets and send
+        them from a background thread instead of during the request.
+        """)
+
+    notification_retries = IntOption('ticketrels', 'notification_retries',
+                                     5, doc=
+        """Number of attempts to send a queued notification before it's
+        dropped.
+        """)
+
+    notification_retry_delay = IntOption('ticketrels',
+                                         'notification_retry_delay', 60, doc=
+        """Seconds to wait before sending a failed notification again,
+        multiplied by the number of attempts.
+        """)
+
+    coalesce_delay = IntOption('ticketrels', 'coalesce_delay', 0, doc=
+        """Seconds during which the child tickets added to or removed from
+        a parent ticket are gathered into a single comment and
+        notification on the parent (0 comments on each change at once).
+        """)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker = None
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        # notifications may have been left over by a previous process
+        if self.async_notification or self.coalesce_delay > 0:
+            self._start_worker()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    def child_changed(self, db, parent, child, author, added):
+        """Comment on the `parent` ticket that the `child` ticket has been
+        added (or removed) and notify the change.
+
+        With `coalesce_delay` set, the change is queued within the
+        transaction of `db` and commented later along with the other
+        changes of the same parent.
+        """
+        if self.coalesce_delay > 0:
+            db("""
+               INSERT INTO ticketrels_pending
+               (parent, child, added, author, time)
+               VALUES (%s, %s, %s, %s, %s)
+               """,
+               (parent, child.id, int(bool(added)), author,
+                to_utimestamp(datetime.now(utc))))
+            return
+
+        from api import _
+        xticket = Ticket(self.env, parent)
+        if added:
+            comment = _('Add a child ticket #%s (%s).') % (child.id, child['summary'])
+        else:
+            comment = _('Remove a child ticket #%s (%s).') % (child.id, child['summary'])
+        xticket.save_changes(author, comment)
+        self.notify(db, xticket)
+
+    def notify(self, db, ticket):
+        """Notify the change of the `ticket` made at its `changetime`.
+
+        The notification is sent immediately unless `async_notification`
+        is set, in which case it's queued within the transaction of `db`,
+        at most once per change. Call `wake()` once the transaction is
+        committed.
+        """
+        if not self.async_notification:
+            tn = TicketNotifyEmail(self.env)
+            tn.notify(ticket, newticket=False, modtime=ticket['changetime'])
+            return
+
+        modtime = to_utimestamp(ticket['changetime'])
+        for row in db("""
+                SELECT attempts FROM ticketrels_notify
+                WHERE ticket=%s AND modtime=%s
+                """,
+                (ticket.id, modtime)):
+            break
+        else:
+            db("""
+               INSERT INTO ticketrels_notify
+               (ticket, modtime, attempts, next_attempt)
+               VALUES (%s, %s, 0, %s)
+               """,
+               (ticket.id, modtime, modtime))
+
+    def wake(self):
+        """Make the background worker process the queued changes."""
+        if self.async_notification or self.coalesce_delay > 0:
+            self._start_worker()
+            self._wakeup.set()
+
+    def comment_pending(self, delay=None):
+        """Comment on the parent tickets the child changes which have been
+        pending for `delay` seconds (`coalesce_delay` by default), one
+        comment per parent and author, and return the number of parents
+        commented on.
+        """
+        from api import _
+        from model import get_tickets_info
+
+        if delay is None:
+            delay = self.coalesce_delay
+        due = to_utimestamp(datetime.now(utc)) - delay * 1000000
+        count = 0
+        for parent, last in self.env.db_query("""
+                SELECT parent, MAX(time) FROM ticketrels_pending
+                GROUP BY parent HAVING MIN(time)<=%s
+                """,
+                (due, )):
+            with self.env.db_transaction as db:
+                changes = db("""
+                        SELECT child, added, author FROM ticketrels_pending
+                        WHERE parent=%s AND time<=%s ORDER BY time
+                        """,
+                        (parent, last))
+                cursor = db.cursor()
+                cursor.execute("""
+                        DELETE FROM ticketrels_pending
+                        WHERE parent=%s AND time<=%s
+                        """,
+                        (parent, last))
+                if not changes or cursor.rowcount == 0:
+                    # taken by another worker
+                    continue
+
+                # net change of each child, by each author in the order
+                # of their first change
+                authors, balances = [], {}
+                for child, added, author in changes:
+                    if author not in balances:
+                        authors.append(author)
+                        balances[author] = {}
+                    balance = balances[author]
+                    balance[child] = balance.get(child, 0) + \
+                                     (1 if added else -1)
+
+                tickets = get_tickets_info(self.env, set(c for c, a, u in changes))
+                def _refs(ids):
+                    return ', '.join('#%s (%s)' % (id, tickets[id]['summary'])
+                                     if id in tickets else '#%s' % id
+                                     for id in ids)
+                entries = []
+                for author in authors:
+                    balance = balances[author]
+                    added = sorted(c for c, n in balance.iteritems() if n > 0)
+                    removed = sorted(c for c, n in balance.iteritems() if n < 0)
+                    comments = []
+                    if added:
+                        comments.append(_('Add child tickets %s.') % _refs(added))
+                    if removed:
+                        comments.append(_('Remove child tickets %s.') % _refs(removed))
+                    if comments:
+                        entries.append((author, '\n\n'.join(comments)))
+                if not entries:
+                    continue
+
+                try:
+                    xticket = Ticket(self.env, parent)
+                except ResourceNotFound:
+                    continue
+                # one change per author, at distinct times
+                when = datetime.now(utc)
+                for author, comment in entries:
+                    xticket.save_changes(author, comment, when)
+                    self.notify(db, xticket)
+                    when += timedelta(microseconds=1)
+                count += 1
+        return count
+
+    def send_queued(self, limit=None):
+        """Send the queued notifications which are due and return the
+        number of notifications sent.
+        """
+        sent = 0
+        while limit is None or sent < limit:
+            now = to_utimestamp(datetime.now(utc))
+            rows = self.env.db_query("""
+                    SELECT ticket, modtime, attempts, next_attempt
+                    FROM ticketrels_notify WHERE next_attempt<=%%s
+                    ORDER BY next_attempt LIMIT %d
+                    """ % BATCH_SIZE,
+                    (now, ))
+            if not rows:
+                break
+
+            for id, modtime, attempts, next_attempt in rows:
+                if not self._claim(id, modtime, attempts, next_attempt, now):
+                    continue
+                if self._send(id, modtime, attempts + 1):
+                    sent += 1
+                if limit is not None and sent >= limit:
+                    break
+        return sent
+
+    def _claim(self, id, modtime, attempts, next_attempt, now):
+        """Reserve a queued notification, so that no other worker sends
+        it until its retry delay has passed."""
+        delay = max(self.notification_retry_delay, 1) * (attempts + 1)
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("""
+                    UPDATE ticketrels_notify
+                    SET attempts=%s, next_attempt=%s
+                    WHERE ticket=%s AND modtime=%s AND next_attempt=%s
+                    """,
+                    (attempts + 1, now + delay * 1000000, id, modtime,
+                     next_attempt))
+            return cursor.rowcount == 1
+
+    def _send(self, id, modtime, attempts):
+        try:
+            ticket = Ticket(self.env, id)
+            tn = TicketNotifyEmail(self.env)
+            tn.notify(ticket, newticket=False,
+                      modtime=from_utimestamp(modtime))
+        except ResourceNotFound:
+            self._dequeue(id, modtime)
+        except Exception, e:
+            if attempts < self.notification_retries:
+                self.log.warn("Failure sending notification on change to "
+                              "ticket #%s, will retry: %s", id,
+                              exception_to_unicode(e))
+            else:
+                self.log.error("Failure sending notification on change to "
+                               "ticket #%s, dropped after %d attempts: %s",
+                               id, attempts,
+                               exception_to_unicode(e, traceback=True))
+                self._dequeue(id, modtime)
+        else:
+            self._dequeue(id, modtime)
+            return True
+        return False
+
+    def _dequeue(self, id, modtime):
+        self.env.db_transaction("""
+                DELETE FROM ticketrels_notify WHERE ticket=%s AND modtime=%s
+                """,
+                (id, modtime))
+
+    def _start_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run,
+                                                name='ticketrels-notifier')
+                self._worker.daemon = True
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            # cleared before the queue is processed, so that a change
+            # queued meanwhile wakes the next wait up
+            self._wakeup.clear()
+            try:
+                if self.coalesce_delay > 0:
+                    self.comment_pending()
+                self.send_queued()
+            except Exception, e:
+                self.log.error("Failure processing the queued changes: %s",
+                               exception_to_unicode(e, traceback=True))
+            timeout = POLL_INTERVAL
+            if self.coalesce_delay > 0:
+                timeout = min(timeout, self.coalesce_delay)
+            self._wakeup.wait(timeout)
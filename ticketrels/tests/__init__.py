@@ -0,0 +1,82 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import unittest
+
+from trac.test import EnvironmentStub
+from trac.ticket.model import Ticket
+
+from ticketrels import db_default
+from ticketrels.api import TicketRelationsSystem
+from ticketrels.notification import TicketRelationsNotifier
+
+def make_environment():
+    """Return a test environment with the tables of the plugin."""
+    env = EnvironmentStub(default_data=True,
+                          enable=['trac.*', 'ticketrels.*'])
+    TicketRelationsSystem(env).environment_created()
+    # the notifications are queued, and sent by the tests instead of the
+    # background worker
+    TicketRelationsNotifier(env)._start_worker = lambda: None
+    return env
+
+def destroy_environment(env):
+    """Drop the tables of the plugin, which are kept by `reset_db`."""
+    with env.db_transaction as db:
+        for table in db_default.tables:
+            db('DROP TABLE IF EXISTS %s' % table.name)
+    env.reset_db()
+
+def insert_ticket(env, **kwargs):
+    """Insert and return a ticket with the given field values."""
+    ticket = Ticket(env)
+    ticket['summary'] = 'Ticket'
+    ticket['reporter'] = 'joe'
+    ticket['status'] = 'new'
+    for name, value in kwargs.iteritems():
+        ticket[name] = value
+    ticket.insert()
+    return ticket
+
+def test_suite():
+    from ticketrels.tests import cache, checker, metrics, model, \
+                                 notification, upgrades, web_ui
+
+    suite = unittest.TestSuite()
+    suite.addTest(cache.test_suite())
+    suite.addTest(checker.test_suite())
+    suite.addTest(metrics.test_suite())
+    suite.addTest(model.test_suite())
+    suite.addTest(notification.test_suite())
+    suite.addTest(upgrades.test_suite())
+    suite.addTest(web_ui.test_suite())
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
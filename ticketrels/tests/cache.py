@@ -0,0 +1,133 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import unittest
+
+from trac.test import MockRequest
+from trac.ticket.model import Ticket
+
+from ticketrels.tests import destroy_environment, insert_ticket, \
+                             make_environment
+from ticketrels.api import TicketParentChildRelations
+from ticketrels.cache import FragmentCache, RelationsCache, \
+                             TicketInfoCache
+from ticketrels.model import bump_generation, get_generation
+
+class TicketInfoCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = make_environment()
+        self.cache = TicketInfoCache(self.env)
+        self.cache.check_generation()
+
+    def tearDown(self):
+        destroy_environment(self.env)
+
+    def test_ticket_changed(self):
+        insert_ticket(self.env, summary='Parent')
+        self.assertEqual('Parent', self.cache.get_tickets([1])[1]['summary'])
+
+        # the edited ticket is dropped, the other processes are not
+        # told to flush their cache
+        generation = get_generation(self.env)
+        ticket = Ticket(self.env, 1)
+        ticket['summary'] = 'Edited'
+        ticket.save_changes('joe', '')
+        self.assertEqual(generation, get_generation(self.env))
+        self.assertEqual('Edited', self.cache.get_tickets([1])[1]['summary'])
+
+    def test_changed_by_other_process(self):
+        insert_ticket(self.env, summary='Parent')
+        self.cache.get_tickets([1])
+
+        # the ticket saved by another process is loaded again
+        self.env.db_transaction("""
+            UPDATE ticket SET summary='Edited', changetime=changetime+1
+            """)
+        self.assertEqual('Edited', self.cache.get_tickets([1])[1]['summary'])
+
+        self.env.db_transaction("DELETE FROM ticket")
+        self.assertEqual({}, self.cache.get_tickets([1]))
+
+    def test_relations_changed(self):
+        insert_ticket(self.env, summary='Parent')
+        self.cache.get_tickets([1])
+        generation = get_generation(self.env)
+        insert_ticket(self.env, parents='1')
+        self.assertNotEqual(generation, get_generation(self.env))
+
+        # the cache is flushed once the relations change
+        self.cache.check_generation()
+        self.assertEqual(0, len(self.cache._tickets))
+
+    def test_not_shared(self):
+        insert_ticket(self.env, summary='Parent')
+        self.cache.get_tickets([1])
+        self.env.db_transaction("UPDATE ticket SET summary='Edited'")
+        self.assertEqual('Parent',
+                         RelationsCache(self.env).get_tickets([1])[1]['summary'])
+        self.assertEqual('Edited',
+                         RelationsCache(self.env, shared=False)
+                         .get_tickets([1])[1]['summary'])
+
+    def test_validate_not_shared(self):
+        insert_ticket(self.env, summary='Parent')
+        self.cache.get_tickets([1])
+        self.env.db_transaction("UPDATE ticket SET status='closed'")
+
+        # the parent closed behind the process-wide cache is seen
+        ticket = Ticket(self.env)
+        ticket['status'] = 'new'
+        ticket['parents'] = '1'
+        errors = list(TicketParentChildRelations(self.env)
+                      .validate_ticket(MockRequest(self.env), ticket))
+        self.assertEqual([('parents', 'Parent ticket #1 is closed')], errors)
+
+    def test_generation_read_once(self):
+        req = MockRequest(self.env)
+        fragments = FragmentCache(self.env)
+        self.cache.pre_process_request(req, None)
+        generation = get_generation(self.env)
+
+        # the caches share the generation read at the beginning of the
+        # request
+        with self.env.db_transaction as db:
+            bump_generation(db)
+        fragments.pre_process_request(req, None)
+        self.assertEqual(generation, fragments._db_generation)
+        fragments.pre_process_request(MockRequest(self.env), None)
+        self.assertNotEqual(generation, fragments._db_generation)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TicketInfoCacheTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
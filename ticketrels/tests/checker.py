@@ -0,0 +1,128 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from trac.env import Environment
+
+from ticketrels.tests import destroy_environment, insert_ticket, \
+                             make_environment
+from ticketrels.checker import check_cycles, check_environment, \
+                               check_hours, repair_hours
+from ticketrels.model import get_subtree_hours
+from ticketrels.upgrades import db3
+
+class CheckCyclesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = make_environment()
+
+    def tearDown(self):
+        destroy_environment(self.env)
+
+    def test_no_cycle(self):
+        insert_ticket(self.env)
+        insert_ticket(self.env, parents='1')
+        insert_ticket(self.env, parents='1, 2')
+        self.assertEqual([], check_cycles(self.env))
+
+    def test_cycle_from_upgrade(self):
+        for i in xrange(4):
+            insert_ticket(self.env)
+        # a circular hierarchy of the relations table before the closure
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO ticketrels (oneself, relations, ticket)
+                VALUES (%s, 'child', %s)
+                """,
+                [(1, 2), (2, 3), (3, 1), (3, 4)])
+            db('DROP TABLE ticketrels_closure')
+            db3.do_upgrade(self.env, 3, db.cursor())
+
+        self.assertEqual([1, 2, 3], check_cycles(self.env))
+
+class CheckHoursTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = make_environment()
+        self.env.config.set('ticket-custom', 'estimatedhours', 'text')
+        self.env.config.set('ticket-custom', 'totalhours', 'text')
+
+    def tearDown(self):
+        destroy_environment(self.env)
+
+    def test_repair(self):
+        insert_ticket(self.env)
+        insert_ticket(self.env, parents='1', estimatedhours='2')
+        insert_ticket(self.env, parents='2', totalhours='1')
+        self.assertEqual([], check_hours(self.env))
+
+        self.env.db_transaction("""
+            UPDATE ticket_custom SET value='4' WHERE name='totalhours'
+            """)
+        problems = check_hours(self.env)
+        self.assertEqual([(1, (2.0, 1.0), (2.0, 4.0)),
+                          (2, (0.0, 1.0), (0.0, 4.0))], problems)
+        repair_hours(self.env, problems)
+        self.assertEqual([], check_hours(self.env))
+        self.assertEqual((2.0, 4.0), get_subtree_hours(self.env, 1))
+
+class CheckEnvironmentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_plugin_not_enabled(self):
+        path = os.path.join(self.dir, 'env')
+        Environment(path, create=True).shutdown()
+        missing = os.path.join(self.dir, 'missing')
+
+        for path in (path, missing):
+            result = check_environment((path, False, 10))
+            self.assertEqual(path, result[0])
+            self.assertEqual(1, len(result[1]))
+            self.assertTrue(result[1][0].startswith('Error: '))
+            self.assertEqual(1, result[2])
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CheckCyclesTestCase))
+    suite.addTest(unittest.makeSuite(CheckHoursTestCase))
+    suite.addTest(unittest.makeSuite(CheckEnvironmentTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import os
+import unittest
+
+from ticketrels.tests import destroy_environment, insert_ticket, \
+                             make_environment
+from ticketrels.metrics import TicketRelationsMetrics, measured
+
+class Hooks(object):
+
+    def __init__(self, env):
+        self.env = env
+
+    @measured
+    def generate(self, ids):
+        for id in ids:
+            self.env.db_query('SELECT id FROM ticket WHERE id=%s', (id, ))
+            yield id
+
+class TicketRelationsMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = make_environment()
+        self.metrics = TicketRelationsMetrics(self.env)
+
+    def tearDown(self):
+        destroy_environment(self.env)
+
+    def _get_metrics(self):
+        return dict((metric['name'], metric)
+                    for metric in self.metrics.get_metrics())
+
+    def test_enabled_after_creation(self):
+        insert_ticket(self.env)
+        self.assertEqual({}, self._get_metrics())
+
+        self.env.config.set('ticketrels', 'instrumentation', 'true')
+        insert_ticket(self.env, parents='1')
+        metric = self._get_metrics()[
+            'TicketParentChildRelations.ticket_created']
+        self.assertEqual(1, metric['calls'])
+        self.assertTrue(metric['sql'] > 0)
+
+    def test_generator(self):
+        self.env.config.set('ticketrels', 'instrumentation', 'true')
+        items = Hooks(self.env).generate([1, 2, 3])
+        self.assertEqual({}, self._get_metrics())
+
+        # measured as the items are consumed
+        self.assertEqual([1, 2, 3], list(items))
+        metric = self._get_metrics()['Hooks.generate']
+        self.assertEqual(1, metric['calls'])
+        self.assertEqual(3, metric['sql'])
+
+    def test_templates_dirs(self):
+        dirs = self.metrics.get_templates_dirs()
+        self.assertTrue(any(os.path.isfile(os.path.join(dir,
+                                'ticketrels_admin_metrics.html'))
+                            for dir in dirs))
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TicketRelationsMetricsTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import unittest
+
+from ticketrels.tests import destroy_environment, insert_ticket, \
+                             make_environment
+from ticketrels.model import TicketLinks, count_open_children, \
+                             get_children_statuses, get_subtree_hours, \
+                             update_closure
+
+class UpdateClosureTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = make_environment()
+        self.env.config.set('ticket-custom', 'estimatedhours', 'text')
+        self.env.config.set('ticket-custom', 'totalhours', 'text')
+        for i in xrange(5):
+            insert_ticket(self.env, status='closed' if i == 4 else 'new',
+                          estimatedhours=str(i + 1))
+
+    def tearDown(self):
+        destroy_environment(self.env)
+
+    def _update(self, *relations):
+        with self.env.db_transaction as db:
+            for parent, child, sign in relations:
+                update_closure(db, parent, child, sign)
+
+    def _closure(self):
+        return self.env.db_query("""
+            SELECT ancestor, descendant, depth, paths
+            FROM ticketrels_closure ORDER BY ancestor, descendant, depth
+            """)
+
+    def test_chain(self):
+        self._update((1, 2, 1), (2, 3, 1))
+        self.assertEqual([(1, 2, 1, 1), (1, 3, 2, 1), (2, 3, 1, 1)],
+                         self._closure())
+
+        # the relation is inserted in the middle of the chain
+        self._update((3, 4, 1))
+        self.assertEqual([(1, 2, 1, 1), (1, 3, 2, 1), (1, 4, 3, 1),
+                          (2, 3, 1, 1), (2, 4, 2, 1), (3, 4, 1, 1)],
+                         self._closure())
+
+        self._update((2, 3, -1))
+        self.assertEqual([(1, 2, 1, 1), (3, 4, 1, 1)], self._closure())
+
+    def test_diamond(self):
+        self._update((1, 2, 1), (1, 3, 1), (2, 4, 1), (3, 4, 1))
+        self.assertEqual([(1, 2, 1, 1), (1, 3, 1, 1), (1, 4, 2, 2),
+                          (2, 4, 1, 1), (3, 4, 1, 1)],
+                         self._closure())
+
+        # the other path is kept
+        self._update((2, 4, -1))
+        self.assertEqual([(1, 2, 1, 1), (1, 3, 1, 1), (1, 4, 2, 1),
+                          (3, 4, 1, 1)],
+                         self._closure())
+
+        self._update((1, 2, -1), (1, 3, -1), (3, 4, -1))
+        self.assertEqual([], self._closure())
+
+    def test_hours(self):
+        self._update((1, 2, 1), (2, 3, 1))
+        self.assertEqual((5.0, 0.0), get_subtree_hours(self.env, 1))
+        self.assertEqual((3.0, 0.0), get_subtree_hours(self.env, 2))
+
+        # a descendant reached through two paths is counted once
+        self._update((1, 3, 1))
+        self.assertEqual((5.0, 0.0), get_subtree_hours(self.env, 1))
+
+        self._update((2, 3, -1))
+        self.assertEqual((5.0, 0.0), get_subtree_hours(self.env, 1))
+        self.assertEqual((0.0, 0.0), get_subtree_hours(self.env, 2))
+
+    def test_children_statuses(self):
+        self._update((1, 2, 1), (1, 5, 1), (2, 3, 1))
+        self.assertEqual({'new': 1, 'closed': 1},
+                         get_children_statuses(self.env, 1))
+        self.assertEqual({'new': 1}, get_children_statuses(self.env, 2))
+
+        self._update((1, 5, -1))
+        self.assertEqual({'new': 1}, get_children_statuses(self.env, 1))
+
+    def test_count_open_children(self):
+        self._update((1, 2, 1), (1, 5, 1))
+        self.assertEqual(1, count_open_children(self.env, 1, ['closed']))
+        self.assertEqual(2, count_open_children(self.env, 1, []))
+        self.assertEqual(0, count_open_children(self.env, 2, []))
+
+class TicketLinksTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = make_environment()
+        
+    def tearDown(self):
+        destroy_environment(self.env)
+
+    def test_delete_parents(self):
+        insert_ticket(self.env)
+        insert_ticket(self.env, parents='1')
+        ticket = insert_ticket(self.env, parents='1, 2')
+        insert_ticket(self.env, parents='3')
+        self.assertEqual({'new': 2}, get_children_statuses(self.env, 1))
+
+        TicketLinks(self.env, ticket).delete_parents()
+        self.assertEqual([(1, 'child', 2), (3, 'child', 4)],
+                         self.env.db_query("""
+                             SELECT oneself, relations, ticket
+                             FROM ticketrels ORDER BY oneself, ticket
+                             """))
+        self.assertEqual([(1, 2, 1, 1), (3, 4, 1, 1)],
+                         self.env.db_query("""
+                             SELECT ancestor, descendant, depth, paths
+                             FROM ticketrels_closure
+                             ORDER BY ancestor, descendant
+                             """))
+        self.assertEqual({'new': 1}, get_children_statuses(self.env, 1))
+        self.assertEqual({}, get_children_statuses(self.env, 2))
+
+    def test_update_hours(self):
+        self.env.config.set('ticket-custom', 'hours', 'text')
+        self.env.config.set('ticket-custom', 'estimatedhours', 'text')
+        self.env.config.set('ticket-custom', 'totalhours', 'text')
+        insert_ticket(self.env)
+        insert_ticket(self.env, parents='1', estimatedhours='2')
+        ticket = insert_ticket(self.env, parents='2', totalhours='1')
+        self.assertEqual((2.0, 1.0), get_subtree_hours(self.env, 1))
+
+        ticket['estimatedhours'] = '5'
+        ticket.save_changes('joe')
+        self.assertEqual((7.0, 1.0), get_subtree_hours(self.env, 1))
+        self.assertEqual((5.0, 1.0), get_subtree_hours(self.env, 2))
+
+        # the Timing and Estimation plugin adds the hours to `totalhours`
+        # in the database, out of the changes of the ticket
+        self.env.db_transaction("""
+            UPDATE ticket_custom SET value='4'
+            WHERE ticket=%s AND name='totalhours'
+            """, (ticket.id, ))
+        TicketLinks(self.env, ticket).update_hours({'hours': '0'})
+        self.assertEqual((7.0, 4.0), get_subtree_hours(self.env, 1))
+        self.assertEqual((5.0, 4.0), get_subtree_hours(self.env, 2))
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(UpdateClosureTestCase))
+    suite.addTest(unittest.makeSuite(TicketLinksTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,239 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import asyncore
+import smtpd
+import threading
+import unittest
+
+from trac.ticket.model import Ticket
+import trac.ticket.web_ui
+
+from ticketrels.tests import destroy_environment, insert_ticket, \
+                             make_environment
+from ticketrels.notification import TicketRelationsNotifier
+
+class SMTPServerStub(smtpd.SMTPServer):
+    """A local SMTP server keeping the messages it receives."""
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self._thread = threading.Thread(target=asyncore.loop,
+                                        kwargs={'timeout': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def stop(self):
+        self.close()
+        self._thread.join(5)
+
+class NotificationQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.smtpd = SMTPServerStub()
+        self.env = make_environment()
+        config = self.env.config
+        config.set('notification', 'smtp_enabled', 'true')
+        config.set('notification', 'smtp_server', '127.0.0.1')
+        config.set('notification', 'smtp_port', self.smtpd.port)
+        config.set('notification', 'smtp_from', 'trac@example.org')
+        config.set('notification', 'smtp_always_cc', 'joe@example.org')
+        config.set('ticketrels', 'notification_retries', 2)
+
+        self.notifier = TicketRelationsNotifier(self.env)
+
+    def tearDown(self):
+        self.smtpd.stop()
+        destroy_environment(self.env)
+
+    def _queue(self):
+        return self.env.db_query("""
+            SELECT ticket, attempts FROM ticketrels_notify ORDER BY ticket
+            """)
+
+    def _make_due(self):
+        self.env.db_transaction("UPDATE ticketrels_notify SET next_attempt=0")
+
+    def test_send_queued(self):
+        insert_ticket(self.env)
+        insert_ticket(self.env, parents='1')
+        self.assertEqual([(1, 0)], self._queue())
+        self.assertEqual([], self.smtpd.messages)
+
+        self.assertEqual(1, self.notifier.send_queued())
+        self.assertEqual([], self._queue())
+        self.assertEqual(1, len(self.smtpd.messages))
+        mailfrom, rcpttos, data = self.smtpd.messages[0]
+        self.assertEqual(['joe@example.org'], rcpttos)
+        self.assertIn('#1: Ticket', data)
+        self.assertIn('Add a child ticket #2 (Ticket).', data)
+
+        # nothing left to send
+        self.assertEqual(0, self.notifier.send_queued())
+        self.assertEqual(1, len(self.smtpd.messages))
+
+    def test_queued_once_per_change(self):
+        parent = insert_ticket(self.env)
+        insert_ticket(self.env, parents='1')
+        with self.env.db_transaction as db:
+            self.notifier.notify(db, Ticket(self.env, parent.id))
+        self.assertEqual([(1, 0)], self._queue())
+
+    def test_retry(self):
+        insert_ticket(self.env)
+        insert_ticket(self.env, parents='1')
+        self.smtpd.stop()
+
+        # the failed notification waits for its retry delay
+        self.assertEqual(0, self.notifier.send_queued())
+        self.assertEqual([(1, 1)], self._queue())
+        self.assertEqual(0, self.notifier.send_queued())
+        self.assertEqual([(1, 1)], self._queue())
+
+        # and is dropped after the last attempt
+        self._make_due()
+        self.assertEqual(0, self.notifier.send_queued())
+        self.assertEqual([], self._queue())
+
+    def test_retry_succeeds(self):
+        insert_ticket(self.env)
+        insert_ticket(self.env, parents='1')
+        port = self.smtpd.port
+        self.env.config.set('notification', 'smtp_port', 1)
+        self.assertEqual(0, self.notifier.send_queued())
+        self.assertEqual([(1, 1)], self._queue())
+
+        self.env.config.set('notification', 'smtp_port', port)
+        self._make_due()
+        self.assertEqual(1, self.notifier.send_queued())
+        self.assertEqual([], self._queue())
+        self.assertEqual(1, len(self.smtpd.messages))
+
+    def test_claimed_by_another_worker(self):
+        insert_ticket(self.env)
+        insert_ticket(self.env, parents='1')
+        ticket, modtime, attempts, next_attempt = self.env.db_query("""
+            SELECT ticket, modtime, attempts, next_attempt
+            FROM ticketrels_notify
+            """)[0]
+        self.assertTrue(self.notifier._claim(ticket, modtime, attempts,
+                                             next_attempt, next_attempt))
+        self.assertFalse(self.notifier._claim(ticket, modtime, attempts,
+                                              next_attempt, next_attempt))
+        self.assertEqual(0, self.notifier.send_queued())
+        self.assertEqual([], self.smtpd.messages)
+
+    def test_woken_while_sending(self):
+        calls = []
+
+        class Stop(Exception):
+            pass
+
+        class Wakeup(object):
+            is_set = False
+            def set(self):
+                self.is_set = True
+            def clear(self):
+                calls.append('clear')
+                self.is_set = False
+            def wait(self, timeout):
+                calls.append('wait')
+                if calls.count('wait') == 2:
+                    raise Stop(self.is_set)
+
+        def send_queued():
+            calls.append('send')
+            wakeup.set()
+
+        # the wake-up is cleared before the queue is processed, so that
+        # a change queued meanwhile is not missed by the next wait
+        wakeup = self.notifier._wakeup = Wakeup()
+        self.notifier.send_queued = send_queued
+        try:
+            self.notifier._run()
+        except Stop, e:
+            self.assertEqual((True, ), e.args)
+        else:
+            self.fail('Stop not raised')
+        self.assertEqual(['clear', 'send', 'wait'] * 2, calls)
+
+class CoalescedCommentsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = make_environment()
+        self.env.config.set('ticketrels', 'coalesce_delay', 60)
+        self.notifier = TicketRelationsNotifier(self.env)
+
+    def tearDown(self):
+        destroy_environment(self.env)
+
+    def _comments(self, id):
+        return self.env.db_query("""
+            SELECT author, newvalue FROM ticket_change
+            WHERE ticket=%s AND field='comment' ORDER BY time
+            """, (id, ))
+
+    def test_one_comment_per_author(self):
+        insert_ticket(self.env)
+        insert_ticket(self.env, summary='A', parents='1')
+        insert_ticket(self.env, summary='B', parents='1')
+        child = Ticket(self.env, 2)
+        child['parents'] = ''
+        child.save_changes('jane', '')
+        self.assertEqual([], self._comments(1))
+
+        self.assertEqual(1, self.notifier.comment_pending(0))
+        self.assertEqual([('joe', 'Add child tickets #2 (A), #3 (B).'),
+                          ('jane', 'Remove child tickets #2 (A).')],
+                         self._comments(1))
+        self.assertEqual(0, self.notifier.comment_pending(0))
+
+    def test_net_change(self):
+        insert_ticket(self.env)
+        insert_ticket(self.env, parents='1')
+        child = Ticket(self.env, 2)
+        child['parents'] = ''
+        child.save_changes('joe', '')
+
+        self.assertEqual(0, self.notifier.comment_pending(0))
+        self.assertEqual([], self._comments(1))
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(NotificationQueueTestCase))
+    suite.addTest(unittest.makeSuite(CoalescedCommentsTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import unittest
+
+from ticketrels.tests import destroy_environment, insert_ticket, \
+                             make_environment
+from ticketrels.model import get_subtree_hours
+from ticketrels.upgrades import db2, db3, db9
+
+class Db2UpgradeTestCase(unittest.TestCase):
+
+    rows = [(1, 'child', 2), (1, 'child', 3), (2, 'child', 4),
+            (4, 'ref', 1)]
+
+    def setUp(self):
+        self.env = make_environment()
+
+    def tearDown(self):
+        with self.env.db_transaction as db:
+            db('DROP TABLE IF EXISTS ticketrels_old')
+        destroy_environment(self.env)
+
+    def _create_old_table(self, name):
+        with self.env.db_transaction as db:
+            db('DROP TABLE IF EXISTS ticketrels')
+            db("""
+                CREATE TABLE %s (oneself integer, relations text,
+                                 ticket integer)
+                """ % name)
+            db.executemany("""
+                INSERT INTO %s (oneself, relations, ticket)
+                VALUES (%%s, %%s, %%s)
+                """ % name, self.rows + self.rows[:2])
+
+    def _upgrade(self):
+        with self.env.db_transaction as db:
+            db2.do_upgrade(self.env, 2, db.cursor())
+        return self.env.db_query("""
+            SELECT oneself, relations, ticket FROM ticketrels
+            ORDER BY oneself, relations, ticket
+            """)
+
+    def test_copy(self):
+        self._create_old_table('ticketrels')
+        self.assertEqual(self.rows, self._upgrade())
+
+    def test_interrupted(self):
+        # the old table and the partial copy left by an interrupted
+        # upgrade
+        self._create_old_table('ticketrels_old')
+        with self.env.db_transaction as db:
+            db("""
+                CREATE TABLE ticketrels (oneself integer, relations text,
+                                         ticket integer)
+                """)
+            db("INSERT INTO ticketrels VALUES (1, 'child', 2)")
+        self.assertEqual(self.rows, self._upgrade())
+        self.assertEqual([], self.env.db_query("""
+            SELECT name FROM sqlite_master WHERE name='ticketrels_old'
+            """))
+
+class Db3UpgradeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = make_environment()
+        
+    def tearDown(self):
+        destroy_environment(self.env)
+
+    def _closure(self):
+        return self.env.db_query("""
+            SELECT ancestor, descendant, depth, paths
+            FROM ticketrels_closure ORDER BY ancestor, descendant, depth
+            """)
+
+    def _upgrade(self):
+        with self.env.db_transaction as db:
+            db('DROP TABLE ticketrels_closure')
+            db3.do_upgrade(self.env, 3, db.cursor())
+
+    def test_backfill(self):
+        insert_ticket(self.env)
+        insert_ticket(self.env, parents='1')
+        insert_ticket(self.env, parents='1')
+        insert_ticket(self.env, parents='2, 3')
+        insert_ticket(self.env, parents='4')
+        closure = self._closure()
+
+        # the same paths as the ones maintained by the relations changes
+        self._upgrade()
+        self.assertEqual(closure, self._closure())
+        self.assertIn((1, 4, 2, 2), closure)
+
+    def test_backfill_cycles(self):
+        for i in xrange(5):
+            insert_ticket(self.env)
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO ticketrels (oneself, relations, ticket)
+                VALUES (%s, 'child', %s)
+                """,
+                [(5, 1), (1, 2), (2, 1), (2, 3), (3, 4)])
+
+        self._upgrade()
+        closure = self._closure()
+        self.assertEqual([], [row for row in closure if row[0] == row[1]])
+        self.assertTrue(max(row[2] for row in closure) <= 5)
+        self.assertIn((5, 4, 4, 1), closure)
+
+class Db9UpgradeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = make_environment()
+        self.env.config.set('ticket-custom', 'estimatedhours', 'text')
+        self.env.config.set('ticket-custom', 'totalhours', 'text')
+
+    def tearDown(self):
+        destroy_environment(self.env)
+
+    def _hours(self):
+        return self.env.db_query("""
+            SELECT ticket, estimatedhours, totalhours FROM ticketrels_hours
+            ORDER BY ticket
+            """)
+
+    def _upgrade(self):
+        with self.env.db_transaction as db:
+            db('DROP TABLE ticketrels_hours')
+            db9.do_upgrade(self.env, 9, db.cursor())
+
+    def test_backfill(self):
+        insert_ticket(self.env, estimatedhours='1')
+        insert_ticket(self.env, parents='1', estimatedhours='2')
+        insert_ticket(self.env, parents='1', totalhours='x')
+        insert_ticket(self.env, parents='2, 3', estimatedhours='4',
+                      totalhours='8')
+        insert_ticket(self.env)
+        hours = self._hours()
+
+        # the same sums as the ones maintained by the relations changes,
+        # across several chunks of ancestors
+        chunk_size = db9.CHUNK_SIZE
+        db9.CHUNK_SIZE = 1
+        try:
+            self._upgrade()
+        finally:
+            db9.CHUNK_SIZE = chunk_size
+        self.assertEqual(hours, self._hours())
+        self.assertEqual((6.0, 8.0), get_subtree_hours(self.env, 1))
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(Db2UpgradeTestCase))
+    suite.addTest(unittest.makeSuite(Db3UpgradeTestCase))
+    suite.addTest(unittest.makeSuite(Db9UpgradeTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
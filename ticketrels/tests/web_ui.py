@@ -0,0 +1,104 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import unittest
+
+from trac.db import sqlite_backend
+from trac.test import MockRequest
+from trac.ticket.model import Ticket
+
+from ticketrels.tests import destroy_environment, insert_ticket, \
+                             make_environment
+from ticketrels.web_ui import TicketRelationsModule
+
+class ValidateTicketTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = make_environment()
+        self.module = TicketRelationsModule(self.env)
+
+    def tearDown(self):
+        destroy_environment(self.env)
+
+    def _validate(self, id, action):
+        req = MockRequest(self.env, args={'action': action})
+        return list(self.module.validate_ticket(req, Ticket(self.env, id)))
+
+    def test_resolve(self):
+        insert_ticket(self.env)
+        insert_ticket(self.env, parents='1')
+        insert_ticket(self.env, parents='1', status='closed')
+        self.assertEqual([(None, '1 child ticket(s) have not been closed '
+                                 'yet'),
+                          (None, 'Child ticket #2 has not been closed yet')],
+                         self._validate(1, 'resolve'))
+        self.assertEqual([], self._validate(2, 'resolve'))
+
+    def test_resolve_counted(self):
+        insert_ticket(self.env)
+        insert_ticket(self.env, parents='1')
+        self.env.db_transaction("UPDATE ticket SET status='closed'")
+
+        # the counts are trusted over the statuses of the children
+        self.assertEqual([(None, '1 child ticket(s) have not been closed '
+                                 'yet')],
+                         self._validate(1, 'resolve'))
+
+class RecursiveQueryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = make_environment()
+        self.module = TicketRelationsModule(self.env)
+
+    def tearDown(self):
+        destroy_environment(self.env)
+
+    def test_sqlite_version(self):
+        class SQLiteStub(object):
+            sqlite_version_info = (3, 8, 2)
+
+        # the version of the library of the module used by Trac
+        sqlite = sqlite_backend.sqlite
+        sqlite_backend.sqlite = SQLiteStub()
+        try:
+            self.assertFalse(self.module._has_recursive_query())
+            SQLiteStub.sqlite_version_info = (3, 8, 3)
+            self.assertTrue(self.module._has_recursive_query())
+        finally:
+            sqlite_backend.sqlite = sqlite
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ValidateTicketTestCase))
+    suite.addTest(unittest.makeSuite(RecursiveQueryTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from trac.db import Table, Column, DatabaseManager
+
+# number of parent tickets whose relations are copied per statement
+CHUNK_SIZE = 1000
+
+
+def _table_exists(scheme, cursor, name):
+    if scheme == 'sqlite':
+        cursor.execute("""
+            SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name=%s
+            """, (name, ))
+    else:
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.tables
+            WHERE table_schema=%s AND table_name=%%s
+            """ % ('current_schema()' if scheme == 'postgres'
+                   else 'DATABASE()'), (name, ))
+    return cursor.fetchone()[0] > 0
+
+
+def do_upgrade(env, version, cursor):
+    """Recreate the `ticketrels` table with its composite primary key.
+
+    The rows are copied from the renamed old table with `INSERT ...
+    SELECT` statements in chunks of parent tickets, so that they never
+    go through the memory of the process.
+
+    The old table is left behind when the upgrade is interrupted on a
+    database without transactional DDL (MySQL): it is then the complete
+    one, and the copy is started again from it.
+    """
+    db_manager, _ = DatabaseManager(env)._get_connector()
+    scheme = DatabaseManager(env).connection_uri.split(':', 1)[0]
+
+    table = Table('ticketrels', key=('oneself', 'relations', 'ticket'))[
+        Column('oneself', type='int'),
+        Column('relations', type='text'),
+        Column('ticket', type='int'),
+    ]
+    old_name = table.name + '_old'
+
+    if not _table_exists(scheme, cursor, old_name):
+        cursor.execute('ALTER TABLE %s RENAME TO %s'
+                       % (table.name, old_name))
+    elif _table_exists(scheme, cursor, table.name):
+        # the partial copy of an interrupted upgrade
+        cursor.execute('DROP TABLE ' + table.name)
+    if scheme == 'postgres':
+        # the primary key keeps its name when the table is renamed, which
+        # is the one of the primary key of the new table
+        cursor.execute('ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s'
+                       % (old_name, table.name + '_pk'))
+    for sql in db_manager.to_sql(table):
+        cursor.execute(sql)
+
+    cursor.execute('SELECT * FROM %s WHERE 1=0' % old_name)
+    cols = [x[0] for x in cursor.description
+                 if x[0] in [c.name for c in table.columns]]
+    cursor.execute('SELECT COUNT(*) FROM ' + old_name)
+    total = cursor.fetchone()[0]
+
+    copied = 0
+    last = None
+    while True:
+        # the upper bound of the next chunk of parent tickets
+        cursor.execute("""
+            SELECT MAX(oneself) FROM (
+                SELECT DISTINCT oneself FROM %s %s
+                ORDER BY oneself LIMIT %d) chunk
+            """ % (old_name, 'WHERE oneself > %s' if last is not None else '',
+                   CHUNK_SIZE),
+            (last, ) if last is not None else ())
+        upper = cursor.fetchone()[0]
+        if upper is None:
+            break
+
+        cursor.execute("""
+            INSERT INTO %s (%s) SELECT DISTINCT %s FROM %s
+            WHERE %s oneself <= %%s
+            """ % (table.name, ','.join(cols), ','.join(cols), old_name,
+                   'oneself > %s AND' if last is not None else ''),
+            (last, upper) if last is not None else (upper, ))
+        copied += cursor.rowcount
+        env.log.info('Copied %d/%d rows of the %s table', copied, total,
+                     table.name)
+        last = upper
+
+    cursor.execute('DROP TABLE ' + old_name)
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from trac.db import Table, Column, Index, DatabaseManager
+
+
+def do_upgrade(env, version, cursor):
+    """Add the `ticketrels_closure` table holding every ancestor and
+    descendant pair of the parent-child relations.
+    """
+    db_manager, _ = DatabaseManager(env)._get_connector()
+
+    table = Table('ticketrels_closure',
+                  key=('ancestor', 'descendant', 'depth'))[
+        Column('ancestor', type='int'),
+        Column('descendant', type='int'),
+        Column('depth', type='int'),
+        Column('paths', type='int'),
+        Index(['descendant']),
+    ]
+    for sql in db_manager.to_sql(table):
+        cursor.execute(sql)
+
+    # the parent-child relations themselves are the paths of depth 1
+    cursor.execute("""
+        INSERT INTO ticketrels_closure (ancestor, descendant, depth, paths)
+        SELECT oneself, ticket, 1, 1 FROM ticketrels
+        WHERE relations='child'
+        """)
+
+    # then extend the paths found at each depth by one more relation, a
+    # path without cycle can't be longer than the number of tickets
+    cursor.execute("""
+        SELECT COUNT(*) FROM (
+          SELECT oneself AS id FROM ticketrels WHERE relations='child'
+          UNION
+          SELECT ticket AS id FROM ticketrels WHERE relations='child'
+        ) t
+        """)
+    max_depth = cursor.fetchone()[0]
+    depth = 1
+    while depth < max_depth:
+        # the circular relations left by the previous versions are not
+        # followed back to their ancestors
+        cursor.execute("""
+            SELECT DISTINCT c.ancestor FROM ticketrels_closure c
+            JOIN ticketrels r ON (r.oneself=c.descendant
+                                  AND r.relations='child')
+            WHERE c.depth=%s AND r.ticket=c.ancestor
+            """, (depth,))
+        cycles = [ancestor for ancestor, in cursor.fetchall()]
+        if cycles:
+            env.log.warning('Circular parent-child relations of the '
+                            'tickets %s, they have to be removed by hand '
+                            '(the checker lists them)',
+                            ', '.join('#%s' % id for id in sorted(cycles)))
+
+        cursor.execute("""
+            INSERT INTO ticketrels_closure (ancestor, descendant, depth, paths)
+            SELECT c.ancestor, r.ticket, %s, SUM(c.paths)
+            FROM ticketrels_closure c
+            JOIN ticketrels r ON (r.oneself=c.descendant
+                                  AND r.relations='child')
+            WHERE c.depth=%s AND r.ticket<>c.ancestor
+            GROUP BY c.ancestor, r.ticket
+            """, (depth + 1, depth))
+        cursor.execute("""
+            SELECT COUNT(*) FROM ticketrels_closure WHERE depth=%s
+            """, (depth + 1,))
+        if not cursor.fetchone()[0]:
+            break
+        depth += 1
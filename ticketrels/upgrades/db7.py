@@ -0,0 +1,66 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import re
+
+# same pattern as `api.NUMBERS_RE`, the upgrade scripts do not depend on
+# the modules of the plugin
+NUMBERS_RE = re.compile(r'\d+', re.U)
+
+# number of tickets whose references are converted per statement
+CHUNK_SIZE = 1000
+
+
+def do_upgrade(env, version, cursor):
+    """Store the references of the `refs` field as `ref` relations in the
+    `ticketrels` table.
+    """
+    last = 0
+    while True:
+        cursor.execute("""
+            SELECT ticket, value FROM ticket_custom
+            WHERE name='refs' AND ticket > %%s
+            ORDER BY ticket LIMIT %d
+            """ % CHUNK_SIZE, (last, ))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        relations = set()
+        for id, value in rows:
+            for ref in NUMBERS_RE.findall(value or ''):
+                relations.add((id, int(ref)))
+        if relations:
+            cursor.executemany("""
+                INSERT INTO ticketrels (oneself, relations, ticket)
+                VALUES (%s, 'ref', %s)
+                """, sorted(relations))
+        last = rows[-1][0]
+        env.log.info('Converted the references of the tickets up to #%d',
+                     last)
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, t-kenji
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from trac.db import Table, Column, DatabaseManager
+
+CHUNK_SIZE = 1000
+
+
+def _to_hours(value):
+    try:
+        return float(value or 0)
+    except ValueError:
+        return 0.0
+
+
+def do_upgrade(env, version, cursor):
+    """Add the `ticketrels_hours` table holding the sums of the hours of
+    the descendants of each ticket.
+    """
+    db_manager, _ = DatabaseManager(env)._get_connector()
+
+    table = Table('ticketrels_hours', key='ticket')[
+        Column('ticket', type='int'),
+        Column('estimatedhours', type='real'),
+        Column('totalhours', type='real'),
+    ]
+    for sql in db_manager.to_sql(table):
+        cursor.execute(sql)
+
+    # sum the hours of the distinct descendants of the ancestors, by
+    # chunks of ancestors so that the memory used doesn't depend on the
+    # size of the hierarchy, the conversion being done in Python as the
+    # fields may hold anything
+    last = 0
+    while True:
+        cursor.execute("""
+            SELECT DISTINCT ancestor FROM ticketrels_closure
+            WHERE ancestor>%%s ORDER BY ancestor LIMIT %d
+            """ % CHUNK_SIZE, (last, ))
+        ancestors = [ancestor for ancestor, in cursor]
+        if not ancestors:
+            break
+        last = ancestors[-1]
+
+        sums = {}
+        cursor.execute("""
+            SELECT c.ancestor, tc.name, tc.value
+            FROM (SELECT DISTINCT ancestor, descendant
+                  FROM ticketrels_closure
+                  WHERE ancestor>=%s AND ancestor<=%s) c
+            JOIN ticket_custom tc ON (tc.ticket=c.descendant)
+            WHERE tc.name IN ('estimatedhours', 'totalhours')
+            """, (ancestors[0], last))
+        for id, name, value in cursor:
+            estimated, total = sums.get(id, (0.0, 0.0))
+            if name == 'estimatedhours':
+                sums[id] = (estimated + _to_hours(value), total)
+            else:
+                sums[id] = (estimated, total + _to_hours(value))
+
+        rows = [(id, ) + sums[id] for id in sorted(sums)
+                if sums[id] != (0.0, 0.0)]
+        if rows:
+            cursor.executemany("""
+                INSERT INTO ticketrels_hours
+                (ticket, estimatedhours, totalhours)
+                VALUES (%s, %s, %s)
+                """, rows)
@@ -27,21 +27,34 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import re
+
+from trac.config import IntOption
 from trac.core import *
-from trac.web.api import IRequestFilter, ITemplateStreamFilter
-from trac.web.chrome import ITemplateProvider, add_stylesheet
-from trac.ticket.api import ITicketManipulator
-from trac.ticket.model import Ticket
-from trac.resource import ResourceNotFound
+from trac.util.presentation import to_json
+from trac.web.api import IRequestFilter, IRequestHandler, \
+                         ITemplateStreamFilter, RequestDone
+from trac.web.chrome import ITemplateProvider, add_script, add_stylesheet
+from trac.ticket.api import ITicketManipulator, TicketSystem
 from trac.util.text import shorten_line
 from genshi.builder import tag
+from genshi.core import Stream
 from genshi.filters import Transformer
 
-from avatar.web_ui import AvatarProvider
+try:
+    from avatar.web_ui import AvatarProvider
+except ImportError:
+    AvatarProvider = None
 
 from api import TicketRelationsSystem, \
                 TicketParentChildRelations, TicketReference, \
-                NUMBERS_RE, _
+                NUMBERS_RE, _, N_
+from cache import FragmentCache, RelationsCache, get_request_cache
+from graph import FORMATS, format_relations, iter_relations
+from metrics import measured
+from model import chunks, count_open_children, count_relations, \
+                  get_children_statuses, get_relations_changetime, \
+                  get_relations_page, get_subtree_hours
 
 TEMPLATE_FILES = [
     'query.html',
@@ -67,11 +80,33 @@ class TicketRelationsModule(Component):
 
     implements(ITemplateProvider,
                IRequestFilter,
+               IRequestHandler,
                ITicketManipulator,
                ITemplateStreamFilter)
 
     restricted_status = TicketParentChildRelations.restricted_status
 
+    max_tree_depth = IntOption('ticketrels', 'max_tree_depth', 1, doc=
+        """Number of levels of the child tickets tree rendered with the
+        ticket page, the deeper levels are loaded on demand (0 renders
+        the whole tree).
+        """)
+
+    max_tree_nodes = IntOption('ticketrels', 'max_tree_nodes', 1000, doc=
+        """Maximum number of child relations loaded for the child tickets
+        tree shown on the ticket page (0 means no limit).
+        """)
+
+    max_child_rows = IntOption('ticketrels', 'max_child_rows', 100, doc=
+        """Number of child tickets rendered at each level of the tree, the
+        next ones are loaded on demand (0 means no limit).
+        """)
+
+    max_ref_rows = IntOption('ticketrels', 'max_ref_rows', 100, doc=
+        """Number of reference tickets rendered with the ticket page, the
+        next ones are loaded on demand (0 means no limit).
+        """)
+
     # ITemplateProvider methods
     def get_htdocs_dirs(self):
         from pkg_resources import resource_filename
@@ -80,44 +115,125 @@ class TicketRelationsModule(Component):
     def get_templates_dirs(self):
         return []
 
+    # IRequestHandler methods
+    def match_request(self, req):
+        if req.path_info == '/ticketrels/export':
+            return True
+        match = re.match(r'/ticketrels/(children|refs)/(\d+)$', req.path_info)
+        if match:
+            req.args['relations'] = match.group(1)
+            req.args['id'] = match.group(2)
+            return True
+
+    @measured
+    def process_request(self, req):
+        if req.path_info == '/ticketrels/export':
+            self._send_export(req)
+
+        id = int(req.args.get('id'))
+        req.perm('ticket', id).require('TICKET_VIEW')
+        try:
+            depth = int(req.args.get('depth', 1))
+        except ValueError:
+            depth = 1
+        try:
+            after = int(req.args.get('after', 0))
+        except ValueError:
+            after = 0
+
+        # a page of the children of one level, deeper ones are requested
+        # again, or of the references
+        cache = get_request_cache(self.env, req)
+        if req.args.get('relations') == 'refs':
+            relation, limit = 'ref', self.max_ref_rows
+            ids = get_relations_page(self.env, id, relation, after, limit)
+            tickets = cache.get_tickets(ids)
+            rows = [self._render_ref_row(req, child, tickets.get(child))
+                    for child in ids]
+        else:
+            relation, limit = 'child', self.max_child_rows
+            ids = get_relations_page(self.env, id, relation, after, limit)
+            tickets = cache.get_tickets(ids, self._get_hours_fields())
+            counts = self._count_children(ids)
+            self._get_avatars(req, [t['owner'] for t in tickets.itervalues()])
+            rows = [self._render_child_row(req, child, tickets[child],
+                                           depth, counts.get(child))
+                    for child in ids if child in tickets]
+
+        if limit > 0 and len(ids) == limit:
+            remaining = count_relations(self.env, id, relation, ids[-1])
+            if remaining:
+                rows.append(self._render_more_row(req, relation, id, ids[-1],
+                                                  remaining, depth))
+        rows = [row.generate().render('xhtml', encoding=None) for row in rows]
+        req.send(to_json({'rows': rows}).encode('utf-8'), 'application/json')
+
+    def _send_export(self, req):
+        """Stream the edge list of the relations, restricted by the
+        `root`, `milestone` and `type` arguments."""
+        req.perm.require('TICKET_VIEW')
+        format = req.args.get('format', 'jsonl')
+        if format not in FORMATS:
+            raise TracError(_('Unknown format "%(format)s"', format=format))
+        kwargs = {}
+        if req.args.get('root'):
+            try:
+                kwargs['root'] = int(req.args.get('root'))
+            except ValueError:
+                raise TracError(_('Invalid ticket id "%(id)s"',
+                                  id=req.args.get('root')))
+        if req.args.get('milestone'):
+            kwargs['milestone'] = req.args.get('milestone')
+        if req.args.get('type'):
+            kwargs['relations'] = req.args.getlist('type')
+
+        req.send_response(200)
+        req.send_header('Content-Type', FORMATS[format] + ';charset=utf-8')
+        req.send_header('Content-Disposition',
+                        'attachment; filename=ticketrels.%s' % format)
+        req.end_headers()
+        for line in format_relations(iter_relations(self.env, **kwargs),
+                                     format):
+            req.write(line)
+        raise RequestDone
+
     # IRequestFilter methods
     def pre_process_request(self, req, handler):
         return handler
 
+    @measured
     def post_process_request(self, req, template, data, content_type):
         path = req.path_info
         if path.startswith('/ticket/') or path.startswith('/newticket'):
             # get parent ticket's data
             if data and 'ticket' in data:
                 ticket = data['ticket']
-                parents = ticket['parents'] or ''
-                refs= ticket['refs'] or ''
-                
+                cache = get_request_cache(self.env, req)
+                parents = cache.parse_ids(ticket['parents'])
+                refs = cache.parse_ids(ticket['refs'])
+
+                # fetch all the linked tickets at once
+                tickets = cache.get_tickets(parents + refs)
                 if len(parents) > 0:
-                    self._append_relations_links(req, data, 'parents', set(NUMBERS_RE.findall(parents)))
+                    self._append_relations_links(req, data, 'parents', parents, tickets)
                 if len(refs) > 0:
-                    self._append_relations_links(req, data, 'refs', set(NUMBERS_RE.findall(refs)))
-    
-                children = self.get_children(ticket.id)
-                if children:
-                    data['children'] = children
+                    self._append_relations_links(req, data, 'refs', refs, tickets)
 
         return template, data, content_type
 
-    def _append_relations_links(self, req, data, name, ids):
+    def _append_relations_links(self, req, data, name, ids, tickets):
         links = []
         for id in sorted(ids, key=lambda x: int(x)):
-            try:
-                ticket = Ticket(self.env, id)
-                elem = tag.a('#%s' % id,
-                             href=req.href.ticket(id),
-                             class_='%s ticket' % ticket['status'],
-                             title=ticket['summary'])
-                if len(links) > 0:
-                    links.append(', ')
-                links.append(elem)
-            except ResourceNotFound, e:
-                pass
+            ticket = tickets.get(int(id))
+            if ticket is None:
+                continue
+            elem = tag.a('#%s' % id,
+                         href=req.href.ticket(id),
+                         class_='%s ticket' % ticket['status'],
+                         title=ticket['summary'])
+            if len(links) > 0:
+                links.append(', ')
+            links.append(elem)
         for field in data.get('fields', ''):
             if field.get('name') == name:
                 field['rendered'] = tag.span(*links)
@@ -126,42 +242,128 @@ class TicketRelationsModule(Component):
     def prepare_ticket(self, req, ticket, fields, actions):
         pass
 
-    def get_children(self, parent_id):
-        children = {}
-        for parent, child in self.env.db_query("""
-                SELECT oneself, ticket FROM ticketrels
-                WHERE oneself=%s AND relations='child'
-                """,
-                (parent_id, )):
-            children[child] = None
-
-        for id in children:
-            children[id] = self.get_children(id)
+    def get_children(self, parent_id, max_depth=None, max_nodes=None):
+        """Return the descendants of `parent_id` as nested dicts,
+        `{child: {grandchild: {...}, ...}, ...}`.
 
-        return children
+        The tree is cut at `max_depth` levels and after `max_nodes` child
+        relations, which default to the `[ticketrels]` options.
+        """
+        if max_depth is None:
+            max_depth = self.max_tree_depth
+        if max_nodes is None:
+            max_nodes = self.max_tree_nodes
 
+        if self._has_recursive_query() and (max_depth > 0 or max_nodes > 0):
+            edges = self._get_subtree_recursive(parent_id, max_depth, max_nodes)
+        else:
+            edges = self._get_subtree_by_level(parent_id, max_depth, max_nodes)
+
+        # build the nested dicts, a ticket having several parents in the
+        # subtree shares its dict
+        nodes = {parent_id: {}}
+        for count, (parent, child) in enumerate(edges):
+            if max_nodes > 0 and count >= max_nodes:
+                self.log.warn('children of ticket #%s are truncated at %d '
+                              'relations', parent_id, max_nodes)
+                break
+            children = nodes.setdefault(parent, {})
+            children[child] = nodes.setdefault(child, {})
+
+        return nodes[parent_id]
+
+    def _has_recursive_query(self):
+        """Return whether the database supports `WITH RECURSIVE`."""
+        scheme = self.config.get('trac', 'database').split(':', 1)[0]
+        if scheme == 'sqlite':
+            # common table expressions are available since SQLite 3.8.3,
+            # the library being the one of the module used by Trac (which
+            # may be pysqlite2)
+            from trac.db.sqlite_backend import sqlite
+            return sqlite.sqlite_version_info >= (3, 8, 3)
+        return scheme == 'postgres'
+
+    def _get_subtree_recursive(self, parent_id, max_depth, max_nodes):
+        """Fetch the `(parent, child)` relations of the whole subtree with
+        a single recursive query."""
+        # without a depth limit the depth is bounded by the number of
+        # relations, which also stops a (broken) circular hierarchy
+        depth = max_depth if max_depth > 0 else max_nodes
+        limit = max_nodes + 1 if max_nodes > 0 else None
+        with self.env.db_query as db:
+            # not a plain SELECT, so it has to go through a cursor
+            cursor = db.cursor()
+            cursor.execute("""
+                WITH RECURSIVE subtree (oneself, ticket, depth) AS (
+                    SELECT oneself, ticket, 1 FROM ticketrels
+                    WHERE oneself=%%s AND relations='child'
+                    UNION
+                    SELECT r.oneself, r.ticket, s.depth + 1
+                    FROM ticketrels r JOIN subtree s ON r.oneself=s.ticket
+                    WHERE r.relations='child' AND s.depth < %%s
+                )
+                SELECT oneself, ticket, MIN(depth) FROM subtree
+                GROUP BY oneself, ticket
+                ORDER BY MIN(depth), oneself, ticket %s
+                """ % ('LIMIT %d' % limit if limit else ''),
+                (parent_id, depth))
+            return [(parent, child) for parent, child, depth in cursor]
+
+    def _get_subtree_by_level(self, parent_id, max_depth, max_nodes):
+        """Fetch the `(parent, child)` relations of the subtree with one
+        query per level."""
+        edges = []
+        visited = set([parent_id])
+        level = [parent_id]
+        depth = 0
+        while level and (max_depth <= 0 or depth < max_depth):
+            depth += 1
+            next_level = []
+            for chunk in chunks(level):
+                for parent, child in self.env.db_query("""
+                        SELECT oneself, ticket FROM ticketrels
+                        WHERE relations='child' AND oneself IN (%s)
+                        """ % ','.join(['%s'] * len(chunk)), chunk):
+                    edges.append((parent, child))
+                    if child not in visited:
+                        visited.add(child)
+                        next_level.append(child)
+            if max_nodes > 0 and len(edges) > max_nodes:
+                break
+            level = next_level
+        return edges
+
+    @measured
     def validate_ticket(self, req, ticket):
         action = req.args.get('action')
+        # the statuses are read from the database, not from the process-wide
+        # cache, as they may have just been changed by another process
+        cache = RelationsCache(self.env, shared=False)
         if action == 'resolve':
-            with self.env.db_query as db:
-                cursor = db.cursor()
-                cursor.execute("""
-                        SELECT oneself, ticket FROM ticketrels
-                        WHERE oneself=%s AND relations='child'
-                        """,
-                        (ticket.id, ))
-
-                for parent, child in cursor:
-                    status = Ticket(self.env, child)['status']
+            # the counts of the children by status are authoritative, the
+            # open children are listed only as details
+            count = count_open_children(self.env, ticket.id,
+                                        self.restricted_status)
+            if not count:
+                return
+            yield None, _('%(num)d child ticket(s) have not been closed '
+                          'yet', num=count)
+            children = cache.get_children(ticket.id)
+            tickets = cache.get_tickets(children)
+            for child in children:
+                if child in tickets:
+                    status = tickets[child]['status']
                     if status not in self.restricted_status:
                         yield None, _('Child ticket #%s has not been closed yet') % (child)
 
         elif action == 'reopen':
-            ids = set(NUMBERS_RE.findall(ticket['parents'] or ''))
+            ids = cache.parse_ids(ticket['parents'])
+            tickets = cache.get_tickets(ids)
             for id in ids:
-                status = Ticket(self.env, id)['status']
-                if status in self.restricted_status:
-                    yield None, _('Parent ticket #%s is %s') % (id, status)
+                if id in tickets:
+                    status = tickets[id]['status']
+                    if status in self.restricted_status:
+                        yield None, _('Parent ticket #%s is %s') % (id, status)
 
     # ITemplateStreamFilter method
     def filter_stream(self, req, method, filename, stream, data):
@@ -170,114 +372,25 @@ class TicketRelationsModule(Component):
 
         if req.path_info.startswith('/ticket/'):
             if 'ticket' in data:
-                # get parents data
                 ticket = data['ticket']
-                # title
-                snippet = tag.div(id='relations')
-                snippet.append(tag.h2(_('Relations'), class_='foldable'))
-
-                div = tag.div(class_='description')
-                link = None
-                if 'TICKET_CREATE' in req.perm(ticket.resource) \
-                   and ticket['status'] not in self.restricted_status:
-
-                    attr = {
-                        'target': '_blank',
-                        'href': req.href.newticket(parents=ticket.id),
-                        'title': _('Create new child ticket')
-                    }
-                    link = tag.span('(', tag.a(_('add'), **attr), ')', class_='addticketrels')
-                div.append(tag.h3(_('Child Tickets '), link))
-
-                if 'children' in data:
-                    # table
-                    tbody = tag.tbody()
-                    div.append(tag.table(tbody, class_='ticketrels'))
-
-                    # tickets
-                    def _func(children, depth=0):
-                        for id in sorted(children, key=lambda x: int(x)):
-                            ticket = Ticket(self.env, id)
-
-                            # 1st column
-                            attr = {
-                                'class_': ticket['status'],
-                                'href': req.href.ticket(id),
-                                'style': 'margin-left: {}px;'.format(depth * 15),
-                            }
-                            summary = tag.td(tag.a(u'#{0} {1}'.format(id, shorten_line(ticket['summary'])), **attr))
-                            # 2nd column
-                            type = tag.td(ticket['type'])
-                            # 3rd column
-                            status = tag.td(ticket['status'])
-                            # 4th column
-                            href = req.href.query(status='!closed',
-                                                  owner=ticket['owner'])
-                            if self.env.is_component_enabled(AvatarProvider):
-                                from avatar.backend import AvatarBackend
-                                avatar = AvatarBackend(self.env, self.config)
-                                owner = tag.td(
-                                        avatar.generate_avatar(
-                                                ticket['owner'],
-                                                'ticket-owner',
-                                                self.config.get('avatar', 'ticket_owner_size')),
-                                        tag.a(
-                                                ticket['owner'],
-                                                href=href),
-                                        name='children-owner')
-                            else:
-                                owner = tag.td(tag.a(ticket['owner'], href=href), name='children-owner')
-                            # 5th column
-                            if 'estimatedhours' in ticket and 'totalhours' in ticket:
-                                est_hours = ticket['estimatedhours']
-                                tot_hours = ticket['totalhours']
-                                hours = tag.td('{} / {} h'.format(tot_hours, est_hours))
-                            else:
-                                hours = tag.td()
-
-                            tbody.append(tag.tr(summary, type, status, owner, hours))
-                            _func(children[id], depth + 1)
-
-                    _func(data['children'])
-
-                link = None
-                if 'TICKET_CREATE' in req.perm(ticket.resource):
-                    props = { 'refs': ticket.id  }
-                    props.update(dict([(i, ticket[i]) for i in COPY_TICKET_FIELDS if ticket[i]]))
-                    attr = {
-                        'target': '_blank',
-                        'href': req.href.newticket(**props),
-                        'title': _('Create new ticket with reference'),
-                    }
-                    link = tag.span('(', tag.a(_('add'), **attr), ')', class_='addticketrels')
-                div.append(tag.h3(_('Reference Tickets '), link))
-
                 for field in data.get('fields', []):
                     if field['name'] == 'refs':
                         if filename.endswith(('ticket_preview.html',)):
                             field['rendered'] = self._link_refs_line(req, ticket['refs'])
                         else:
                             field['rendered'] = tag.a(_('See Relations'), href='#relations')
-                            if ticket['refs']:
-
-                                tbody = tag.tbody()
-                                div.append(tag.table(tbody, class_='ticketrels'))
-
-                                for id in sorted(set(int(i) for i in NUMBERS_RE.findall(ticket['refs']))):
-                                    try:
-                                        ticket = Ticket(self.env, id)
-
-                                        attr = {
-                                            'class_': ticket['status'],
-                                            'href': req.href.ticket(id),
-                                        }
-                                        summary = tag.td(tag.a(u'#{0} {1}'.format(id, shorten_line(ticket['summary'])), **attr))
-                                        tbody.append(tag.tr(summary))
-                                    except ResourceNotFound:
-                                        self.log.warn(u'ticket not found: {}'.format(id))
-                                        tbody.append(tag.tr(tag.td(tag.span(_('#{} ticket not found').format(id)))))
-
-                snippet.append(div)
+
+                # the relations are rendered again only when they or one
+                # of the related tickets have changed
+                render = lambda: self._render_relations(req, ticket, filename, data)
+                fragments = self.env[FragmentCache]
+                if fragments:
+                    key = self._get_fragment_key(req, ticket, filename)
+                    snippet, scripted = fragments.get_fragment(key, render)
+                else:
+                    snippet, scripted = render()
+                if scripted:
+                    add_script(req, 'ticketrels/js/ticketrels.js')
                 add_stylesheet(req, 'ticketrels/css/ticketrels.css')
                 stream |= Transformer('.//div[@id="ticket"]').after(snippet)
 
@@ -288,48 +401,333 @@ class TicketRelationsModule(Component):
         if filename == 'report_view.html':
             self._filter_row_groups(req, data)
 
+        # gather the ids added or removed by all the changes first, to
+        # fetch their tickets and render their links only once
+        diffs = []
         for changes in data.get('changes', []):
-            def _field_changes_rerender(changes, name):
+            for name in ('parents', 'refs'):
                 field = changes.get('fields', {}).get(name)
                 if field:
                     old = set(int(i) for i in NUMBERS_RE.findall(field.get('old')))
                     new = set(int(i) for i in NUMBERS_RE.findall(field.get('new')))
                     if len(old) < len(new):
-                        msg_key = 'added'
-                        diff_ids = new.difference(old)
+                        diffs.append((field, N_('added'), new.difference(old)))
                     else:
-                        msg_key = 'removed'
-                        diff_ids = old.difference(new)
+                        diffs.append((field, N_('removed'), old.difference(new)))
+
+        if diffs:
+            tickets = get_request_cache(self.env, req).get_tickets(
+                set().union(*[diff_ids for field, msg_key, diff_ids in diffs]))
+            links = {}
+            for field, msg_key, diff_ids in diffs:
+                elements = []
+                for _id in sorted(diff_ids):
+                    if _id not in links:
+                        links[_id] = self._link_ref(req, _id, tickets)
+                    elements.append(links[_id])
+                if elements:
+                    comma, f = tag.span(u', '), lambda x, y: x + comma + y
+                    field['rendered'] =  reduce(f, elements)
+                    field['rendered'] += tag.span(u' ' + _(msg_key))
 
-                    elements = [self._link_ref(req, _id) for _id in diff_ids]
-                    if elements:
-                        comma, f = tag.span(u', '), lambda x, y: x + comma + y
-                        field['rendered'] =  reduce(f, elements)
-                        field['rendered'] += tag.span(u' ' + _(msg_key))
+        return stream
 
-            _field_changes_rerender(changes, 'parents')
-            _field_changes_rerender(changes, 'refs')
+    def _get_hours_fields(self):
+        """Return the names of the hours fields if they are defined."""
+        hours_fields = ('estimatedhours', 'totalhours')
+        custom_fields = [f['name'] for f in
+                         TicketSystem(self.env).custom_fields]
+        if all(f in custom_fields for f in hours_fields):
+            return hours_fields
+        return ()
+
+    def _count_children(self, ids):
+        """Return the number of children of the tickets as `{id: count}`."""
+        counts = {}
+        for chunk in chunks(sorted(ids)):
+            for id, count in self.env.db_query("""
+                    SELECT oneself, COUNT(*) FROM ticketrels
+                    WHERE relations='child' AND oneself IN (%s)
+                    GROUP BY oneself
+                    """ % ','.join(['%s'] * len(chunk)), chunk):
+                counts[id] = count
+        return counts
+
+    def _get_avatars(self, req, owners):
+        """Return the avatars of the `owners` as `{owner: avatar}`, or
+        `None` if the avatar plugin is not enabled.
+
+        The avatar backend is set up once per request, and the avatar of
+        each owner generated only once.
+        """
+        avatars = getattr(req, '_ticketrels_avatars', None)
+        if avatars is None:
+            if AvatarProvider is not None and \
+                    self.env.is_component_enabled(AvatarProvider):
+                from avatar.backend import AvatarBackend
+                backend = AvatarBackend(self.env, self.config)
+                size = self.config.get('avatar', 'ticket_owner_size')
+                avatars = (backend, size, {})
+            else:
+                avatars = (None, None, None)
+            req._ticketrels_avatars = avatars
+
+        backend, size, memo = avatars
+        if backend is None:
+            return None
+        for owner in set(owners) - set(memo):
+            memo[owner] = backend.generate_avatar(owner, 'ticket-owner', size)
+        return memo
+
+    @measured
+    def _render_relations(self, req, ticket, filename, data):
+        """Render the relations of the ticket, as a stream and whether the
+        script loading the next rows is needed."""
+        # the relations are rendered again when one of the related tickets
+        # has changed, possibly in another process, so their data is not
+        # taken from the process-wide cache
+        cache = RelationsCache(self.env, shared=False)
+        scripted = False
+
+        # title
+        snippet = tag.div(id='relations')
+        snippet.append(tag.h2(_('Relations'), class_='foldable'))
+
+        div = tag.div(class_='description')
+        link = None
+        if 'TICKET_CREATE' in req.perm(ticket.resource) \
+           and ticket['status'] not in self.restricted_status:
 
-        return stream
+            attr = {
+                'target': '_blank',
+                'href': req.href.newticket(parents=ticket.id),
+                'title': _('Create new child ticket')
+            }
+            link = tag.span('(', tag.a(_('add'), **attr), ')', class_='addticketrels')
+        statuses = get_children_statuses(self.env, ticket.id)
+        if statuses:
+            closed = sum(count for status, count in statuses.iteritems()
+                         if status in self.restricted_status)
+            progress = tag.span(_('%(closed)d/%(total)d closed',
+                                  closed=closed,
+                                  total=sum(statuses.itervalues())),
+                                class_='ticketrelsprogress')
+        else:
+            progress = None
+        div.append(tag.h3(_('Child Tickets '), link, progress))
+
+        # hours of the whole subtree, kept up to date as the tickets
+        # change
+        hours = self._get_hours_fields() and \
+                get_subtree_hours(self.env, ticket.id)
+        if hours:
+            div.append(tag.p(_('Total of the descendants: %(total)s / %(estimated)s h',
+                               total='%g' % hours[1], estimated='%g' % hours[0]),
+                             class_='ticketrelshours'))
+
+        children = cache.get_subtree(ticket.id, self.get_children)
+        if children:
+            # table
+            tbody = tag.tbody()
+            div.append(tag.table(tbody, class_='ticketrels'))
+
+            # the first children of each level only, the next ones are
+            # loaded on demand
+            def _shown(children):
+                ids = sorted(children, key=lambda x: int(x))
+                if self.max_child_rows > 0:
+                    return ids[:self.max_child_rows]
+                return ids
+
+            # fetch all the child tickets at once
+            def _collect(children, ids):
+                for id in _shown(children):
+                    if id not in ids:
+                        ids.add(id)
+                        _collect(children[id], ids)
+                return ids
+
+            tickets = cache.get_tickets(_collect(children, set()),
+                                        self._get_hours_fields())
+
+            # the deeper levels of the tree are loaded on demand from the
+            # leaves which have children
+            def _leaves(children, ids):
+                for id in _shown(children):
+                    if not children[id]:
+                        ids.add(id)
+                    elif id not in ids:
+                        _leaves(children[id], ids)
+                return ids
+            counts = self._count_children(_leaves(children, set()))
+            self._get_avatars(req, [t['owner'] for t in tickets.itervalues()])
+
+            # tickets
+            def _func(children, depth=0, path=(ticket.id,)):
+                ids = _shown(children)
+                for id in ids:
+                    ticket = tickets.get(int(id))
+                    if ticket is None or id in path:
+                        continue
+
+                    count = not children[id] and counts.get(id)
+                    tbody.append(self._render_child_row(req, id, ticket, depth, count))
+                    _func(children[id], depth + 1, path + (id,))
+                if len(ids) < len(children):
+                    tbody.append(self._render_more_row(req, 'child', path[-1], ids[-1],
+                                                       len(children) - len(ids), depth))
+
+            _func(children)
+            scripted = True
+
+        link = None
+        if 'TICKET_CREATE' in req.perm(ticket.resource):
+            props = { 'refs': ticket.id  }
+            props.update(dict([(i, ticket[i]) for i in COPY_TICKET_FIELDS if ticket[i]]))
+            attr = {
+                'target': '_blank',
+                'href': req.href.newticket(**props),
+                'title': _('Create new ticket with reference'),
+            }
+            link = tag.span('(', tag.a(_('add'), **attr), ')', class_='addticketrels')
+        div.append(tag.h3(_('Reference Tickets '), link))
+
+        if any(field['name'] == 'refs' for field in data.get('fields', [])) \
+           and not filename.endswith(('ticket_preview.html',)) \
+           and ticket['refs']:
+            tbody = tag.tbody()
+            div.append(tag.table(tbody, class_='ticketrels'))
+
+            # the first references only, the next ones are loaded on
+            # demand, paged from the same relations as `process_request`
+            limit = self.max_ref_rows
+            ids = get_relations_page(self.env, ticket.id, 'ref', None, limit)
+            tickets = cache.get_tickets(ids)
+            for id in ids:
+                tbody.append(self._render_ref_row(req, id, tickets.get(id)))
+            if limit > 0 and len(ids) == limit:
+                remaining = count_relations(self.env, ticket.id, 'ref',
+                                            ids[-1])
+                if remaining:
+                    tbody.append(self._render_more_row(req, 'ref', ticket.id,
+                                                       ids[-1], remaining))
+                    scripted = True
+
+        snippet.append(div)
+        return Stream(list(snippet.generate())), scripted
+
+    def _get_fragment_key(self, req, ticket, filename):
+        """Return the key of the rendered relations of the ticket in the
+        `FragmentCache`.
+
+        Besides the related tickets, the relations depend on the fields of
+        the ticket copied to the new tickets, on the TICKET_CREATE
+        permission and on the locale.
+        """
+        values = tuple(ticket[name] for name in
+                       ['status', 'refs'] + COPY_TICKET_FIELDS)
+        return (ticket.id, filename, values,
+                'TICKET_CREATE' in req.perm(ticket.resource),
+                str(req.locale), req.href(),
+                get_relations_changetime(self.env, ticket.id))
+
+    def _render_child_row(self, req, id, ticket, depth, children=None):
+        """Render the row of a child ticket, with a link to load its own
+        `children` if they are not rendered."""
+        # 1st column
+        attr = {
+            'class_': ticket['status'],
+            'href': req.href.ticket(id),
+            'style': 'margin-left: {}px;'.format(depth * 15),
+        }
+        summary = tag.td(tag.a(u'#{0} {1}'.format(id, shorten_line(ticket['summary'])), **attr))
+        if children:
+            attr = {
+                'class_': 'expandticketrels',
+                'href': req.href.ticketrels('children', id, depth=depth + 1),
+                'title': _('Show child tickets'),
+            }
+            summary.append(tag.a(u'(+%d)' % children, **attr))
+        # 2nd column
+        type = tag.td(ticket['type'])
+        # 3rd column
+        status = tag.td(ticket['status'])
+        # 4th column
+        href = req.href.query(status='!closed',
+                              owner=ticket['owner'])
+        avatars = self._get_avatars(req, [ticket['owner']])
+        if avatars is not None:
+            owner = tag.td(
+                    avatars[ticket['owner']],
+                    tag.a(
+                            ticket['owner'],
+                            href=href),
+                    name='children-owner')
+        else:
+            owner = tag.td(tag.a(ticket['owner'], href=href), name='children-owner')
+        # 5th column
+        if 'estimatedhours' in ticket and 'totalhours' in ticket:
+            est_hours = ticket['estimatedhours']
+            tot_hours = ticket['totalhours']
+            hours = tag.td('{} / {} h'.format(tot_hours, est_hours))
+        else:
+            hours = tag.td()
 
-    def _link_ref(self, req, ref_id):
-        try:
-            ticket = Ticket(self.env, ref_id)
+        return tag.tr(summary, type, status, owner, hours)
+
+    def _render_ref_row(self, req, id, ref):
+        """Render the row of a reference ticket."""
+        if ref is not None:
+            attr = {
+                'class_': ref['status'],
+                'href': req.href.ticket(id),
+            }
+            summary = tag.td(tag.a(u'#{0} {1}'.format(id, shorten_line(ref['summary'])), **attr))
+            return tag.tr(summary)
+        else:
+            self.log.warn(u'ticket not found: {}'.format(id))
+            return tag.tr(tag.td(tag.span(_('#{} ticket not found').format(id))))
+
+    def _render_more_row(self, req, relation, id, after, remaining, depth=0):
+        """Render the row of the link loading the next related tickets,
+        `after` being the last rendered one."""
+        text = _('Show %(num)d more', num=remaining)
+        if relation == 'child':
+            attr = {
+                'class_': 'moreticketrels',
+                'href': req.href.ticketrels('children', id, after=after, depth=depth),
+                'style': 'margin-left: {}px;'.format(depth * 15),
+            }
+            return tag.tr(tag.td(tag.a(text, **attr), colspan=5))
+        else:
+            attr = {
+                'class_': 'moreticketrels',
+                'href': req.href.ticketrels('refs', id, after=after),
+            }
+            return tag.tr(tag.td(tag.a(text, **attr)))
+
+    def _link_ref(self, req, ref_id, tickets):
+        ticket = tickets.get(int(ref_id))
+        if ticket is not None:
             attr = {
                 'class_': ticket['status'],
                 'href': req.href.ticket(ref_id),
                 'title': shorten_line(ticket['summary']),
             }
             elem = tag.a('#{}'.format(ref_id), **attr)
-        except ResourceNotFound:
+        else:
             self.log.warn('ticket not found: {}'.format(ref_id))
             elem = tag.span('#{}'.format(ref_id))
         return elem
 
-    def _link_refs_line(self, req, refs_text):
+    def _link_refs_line(self, req, refs_text, tickets=None):
+        cache = get_request_cache(self.env, req)
+        ids = cache.parse_ids(refs_text)
+        if tickets is None:
+            tickets = cache.get_tickets(ids)
         refs = []
-        for _id in sorted(set(int(i) for i in NUMBERS_RE.findall(refs_text))):
-            refs.extend([self._link_ref(req, _id), ', '])
+        for _id in ids:
+            refs.extend([self._link_ref(req, _id, tickets), ', '])
 
         if refs:
             return tag.span(refs[:-1])
@@ -337,23 +735,36 @@ class TicketRelationsModule(Component):
             return tag.span(refs_text)
 
     def _filter_groups(self, req, data):
+        cells = []
         for group, tickets in data.get('groups', []):
             for ticket in tickets:
                 if 'parents' in ticket:
                     if 'parents' in data.get('col'):
-                        ticket['parents'] = self._link_refs_line(req, ticket['parents'])
+                        cells.append((ticket, 'parents'))
                 if 'refs' in ticket:
                     if 'refs' in data.get('col'):
-                        ticket['refs'] = self._link_refs_line(req, ticket['refs'])
+                        cells.append((ticket, 'refs'))
+        self._link_refs_cells(req, cells)
 
     def _filter_row_groups(self, req, data):
+        cells = []
         for group, rows in data.get('row_groups', []):
             for row in rows:
                 _is_list = isinstance(row['cell_groups'], list)
                 if 'cell_groups' in row and _is_list:
-                    for cells in row['cell_groups']:
-                        for cell in cells:
-                            if cell.get('header', {}).get('col') == 'parents':
-                                cell['value'] = self._link_refs_line(req, cell['value'])
-                            if cell.get('header', {}).get('col') == 'refs':
-                                cell['value'] = self._link_refs_line(req, cell['value'])
+                    for cell_group in row['cell_groups']:
+                        for cell in cell_group:
+                            if cell.get('header', {}).get('col') in ('parents', 'refs'):
+                                cells.append((cell, 'value'))
+        self._link_refs_cells(req, cells)
+
+    def _link_refs_cells(self, req, cells):
+        """Replace the `(container, key)` cells of the page by links to
+        the tickets, fetching all the tickets of the page at once."""
+        cache = get_request_cache(self.env, req)
+        ids = set()
+        for container, key in cells:
+            ids.update(cache.parse_ids(container[key]))
+        tickets = cache.get_tickets(ids)
+        for container, key in cells:
+            container[key] = self._link_refs_line(req, container[key], tickets)